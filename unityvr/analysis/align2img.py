@@ -3,13 +3,79 @@ import numpy as np
 import matplotlib.pyplot as plt
 from unityvr.viz import utils as vutils
 import pandas as pd
+import xarray as xr
 from os.path import sep
 import json
 from unityvr.preproc import logproc
 from unityvr.analysis import utils as autils
 import scipy as sp
 
-def findImgFrameTimes(uvrDat,imgMetadat,diffVal=3, pdAlign=False, **kwargs):
+# Chunked edge detection on NI-DAQ signals ......................................
+# signals are processed in chunks of chunksize samples, carrying the state at chunk borders,
+# so temporary arrays stay bounded on long recordings
+
+def thresholdCrossings(signal, thresh, direction='both', chunksize=2**20):
+    # indices i where (signal > thresh) changes between sample i and i+1 (as np.diff of the thresholded signal)
+    # direction: 'both', 'up' (crossing upwards) or 'down'
+    crossings = []
+    prev = None
+    for start in range(0, len(signal), chunksize):
+        above = np.asarray(signal[start:start+chunksize]) > thresh
+        if prev is not None: above = np.r_[prev, above]
+        offset = start - 1 if prev is not None else start
+        if direction == 'up': change = ~above[:-1] & above[1:]
+        elif direction == 'down': change = above[:-1] & ~above[1:]
+        else: change = above[:-1] != above[1:]
+        crossings.append(np.flatnonzero(change) + offset)
+        prev = above[-1:]
+    return np.concatenate(crossings) if crossings else np.array([], dtype=int)
+
+def smoothedChunks(signal, smoothing, chunksize=2**20, truncate=4.0):
+    # gaussian_filter1d of signal, yielded in chunks (start, smoothed values)
+    # chunks are filtered with a halo of the kernel radius, so values equal filtering the whole signal
+    radius = int(truncate*float(smoothing) + 0.5)
+    for start in range(0, len(signal), chunksize):
+        lo, hi = max(start-radius, 0), min(start+chunksize+radius, len(signal))
+        smoothed = sp.ndimage.gaussian_filter1d(np.asarray(signal[lo:hi], dtype=float), smoothing, truncate=truncate)
+        yield start, smoothed[start-lo:start-lo+min(chunksize, len(signal)-start)]
+
+def forwardFillInvalid(values, validValues, chunksize=2**20):
+    # replace values that are not in validValues by the last valid value before them (NaN if there is none)
+    # returns the filled (float) values and the number of invalid values
+    out = np.empty(len(values))
+    last, nInvalid = np.nan, 0
+    for start in range(0, len(values), chunksize):
+        v = np.asarray(values[start:start+chunksize], dtype=float)
+        valid = np.isin(values[start:start+chunksize], validValues)
+        idx = np.where(valid, np.arange(len(v)), -1)
+        np.maximum.accumulate(idx, out=idx)
+        out[start:start+len(v)] = np.where(idx >= 0, v[np.maximum(idx, 0)], last)
+        if np.any(valid): last = v[np.flatnonzero(valid)[-1]]
+        nInvalid += np.sum(~valid)
+    return out, nInvalid
+
+class frameIndex:
+    """ Sorted index of the frame column of a unity dataframe, built once per table
+    lookup returns the position of the first row with each queried frame (as np.where(frame == frames)[0][0])
+    and skips frames that are not in the table.
+    """
+    def __init__(self, frames):
+        frames = np.asarray(frames)
+        self.sorter = np.argsort(frames, kind='stable')
+        self.sortedFrames = frames[self.sorter]
+
+    def find(self, query):
+        # first row of each queried frame and a mask of the frames that were found
+        query = np.asarray(query)
+        loc = np.searchsorted(self.sortedFrames, query, side='left')
+        found = loc < len(self.sortedFrames)
+        found[found] = self.sortedFrames[loc[found]] == query[found]
+        return self.sorter[loc[found]], found
+
+    def lookup(self, query):
+        return self.find(query)[0]
+
+def findImgFrameTimes(uvrDat,imgMetadat,diffVal=3, pdAlign=False, chunksize=2**20, **kwargs):
     #find the dropped frames and use those to clean up nidDf
     if pdAlign:
         uvrDat.nidDf, _ = alignWithPdSignal(uvrDat.nidDf, **kwargs)
@@ -18,7 +84,7 @@ def findImgFrameTimes(uvrDat,imgMetadat,diffVal=3, pdAlign=False, **kwargs):
 
     #find the start of each volume from the analog signal
     #now relies on upward crossing of a threshold line
-    imgInd = np.where(np.diff((uvrDat.nidDf['imgfsig'].values > diffVal).astype(int)) == 1)[0]
+    imgInd = thresholdCrossings(uvrDat.nidDf['imgfsig'].values, diffVal, 'up', chunksize)
 
     print('Number of imaging frames detected:', len(imgInd))
     
@@ -26,7 +92,7 @@ def findImgFrameTimes(uvrDat,imgMetadat,diffVal=3, pdAlign=False, **kwargs):
 
     #take only every x frame as start of volume
     volFrame = imgFrame[0::imgMetadat['fpv']]
-    volFramePos = np.array([np.where(volFrame[i] == uvrDat.posDf.frame.values)[0][0] for i in range(len(volFrame)) if volFrame[i] in uvrDat.posDf.frame.values])
+    volFramePos = frameIndex(uvrDat.posDf.frame.values).lookup(volFrame)
     #volFramePos = np.where(np.in1d(uvrDat.posDf.frame.values,volFrame, ))[0]
 
     return imgInd, volFramePos
@@ -36,9 +102,11 @@ def debugAlignmentPlots(uvrDat, imgMetadat, imgInd, volFramePos, lims=[0,100]):
     fig, axs = plt.subplots(1,3, figsize=(15,4), width_ratios=[1,1,1])
 
     # sanity check if frame starts are detected correctly from analog signal
-    axs[0].plot(np.arange(0,len(uvrDat.nidDf.imgfsig.values)), uvrDat.nidDf.imgfsig, '.-')
-    axs[0].plot(np.arange(0,len(uvrDat.nidDf.imgfsig.values))[imgInd],
-             uvrDat.nidDf.imgfsig[imgInd], 'r.')
+    # (only the samples within lims are drawn)
+    imgfsig = uvrDat.nidDf.imgfsig.values
+    vutils.plotEnvelope(axs[0], imgfsig, xlim=lims, fmt='.-')
+    imgIndInLims = imgInd[np.searchsorted(imgInd, lims[0]):np.searchsorted(imgInd, lims[1], 'right')]
+    axs[0].plot(imgIndInLims, imgfsig[imgIndInLims], 'r.')
     axs[0].set_xlim(lims[0],lims[1])
     axs[0].set_title('Sanity check 1:\nCheck if frame starts are detected correctly')
     vutils.myAxisTheme(axs[0])
@@ -55,7 +123,8 @@ def debugAlignmentPlots(uvrDat, imgMetadat, imgInd, volFramePos, lims=[0,100]):
 
     # sanity check to see the difference in frame start times
     fps = imgMetadat['fpsscan'] #frame rate of scanimage
-    sampling_rate = len(uvrDat.nidDf.dropna())/(uvrDat.nidDf.dropna()['time'].iloc[-1]-uvrDat.nidDf.dropna()['time'].iloc[0])
+    validTime = uvrDat.nidDf['time'].values[uvrDat.nidDf.notna().all(axis=1).values]
+    sampling_rate = len(validTime)/(validTime[-1]-validTime[0])
     axs[2].axvline(int(np.round(sampling_rate/fps)), color='r', linestyle='-')
     axs[2].axvline(int(np.round(sampling_rate/fps))+1, color='r', linestyle='--')
     axs[2].axvline(int(np.round(sampling_rate/fps))-1, color='r', linestyle='--')
@@ -104,7 +173,8 @@ def generateUnityExpDf(imgVolumeTimes, uvrDat, imgMetadat, suppressDepugPlot = F
             unityDf = getattr(uvrDat,unityDfstr)
             if (frameStr in unityDf):
                 if len(unityDf[frameStr].unique())==len(unityDf[frameStr]):
-                        volFrameId = np.array([np.where(volFrame[i] == unityDf.frame.values)[0][0] for i in range(len(volFrame)) if volFrame[i] in unityDf.frame.values])
+                        volFrameId = frameIndex(unityDf.frame.values).lookup(volFrame)
+                        if len(volFrameId) == 0: continue
                         # try: volFrameId = np.array([np.where(volFrame[i] == unityDf.frame.values)[0][0] for i in range(len(volFrame))])
                         # except IndexError: 
                         #     volFrameId = np.where(np.in1d(unityDf.frame.values,volFrame, ))[0]
@@ -275,12 +345,67 @@ def addImagingTimeToUvrDat(imgDataTime, uvrDat, imgMetadat, timeStr = 'volumes [
                 setattr(uvrDat,f,unityDf)
     return uvrDat
 
-def find_upticks(signal, smoothing=3):
-    smoothed_signal = sp.ndimage.gaussian_filter1d(signal[~np.isnan(signal)], smoothing)
-    normed_smoothed_signal = smoothed_signal-np.max(smoothed_signal)/2
-    sign_changes = np.sign(normed_smoothed_signal)
-    positive_zero_crossings = np.where((sign_changes[:-1] < 0) & (sign_changes[1:] > 0))[0]
-    return positive_zero_crossings
+# export an aligned experiment as an xarray Dataset with the imaging volume times as shared coordinate
+
+def expDfToDataset(expDf, imgData=None, uvrDat=None, roiname='slice', timeStr='volumes [s]', chunks=None,
+                   dataframeAppend='Df'):
+    # behaviour and texture variables of expDf become 1D variables along timeStr,
+    # roi dF/F columns of imgData (e.g. roiDFF.csv) a (timeStr x roi) variable 'dff'
+    # with uvrDat, each variable records the unity dataframe it came from in attrs['source']
+    # chunks (e.g. {timeStr: 10000}) backs the variables with dask arrays for lazy, chunked access
+    behDf = expDf.drop_duplicates(subset=timeStr).set_index(timeStr).sort_index()
+    ds = xr.Dataset({col: (timeStr, behDf[col].values) for col in behDf.columns},
+                    coords={timeStr: behDf.index.values})
+
+    if uvrDat is not None:
+        for f in uvrDat.__dataclass_fields__:
+            if dataframeAppend in f:
+                for col in getattr(uvrDat, f).columns:
+                    if col in ds and 'source' not in ds[col].attrs: ds[col].attrs['source'] = f
+
+    if imgData is not None:
+        roinames = [key for key in imgData.keys() if roiname in key]
+        imgDf = imgData.drop_duplicates(subset=timeStr).set_index(timeStr).reindex(ds[timeStr].values)
+        ds['dff'] = ((timeStr, 'roi'), imgDf[roinames].values)
+        ds = ds.assign_coords(roi=roinames)
+        for col in imgDf.columns:
+            if col not in roinames and col not in ds: ds[col] = (timeStr, imgDf[col].values)
+
+    if chunks is not None: ds = ds.chunk(chunks)
+    return ds
+
+def generateExpDataset(imgData, uvrDat, imgMetadat, roiname='slice', timeStr='volumes [s]', chunks=None,
+                       dataframeAppend='Df', generateExpDf_params={}):
+    # align the unity dataframes to the imaging volumes (generateUnityExpDf) and export them with the roi dF/F
+    expDf = generateUnityExpDf(imgData[timeStr].values, uvrDat, imgMetadat, timeStr=timeStr,
+                               dataframeAppend=dataframeAppend, **generateExpDf_params)
+    return expDfToDataset(expDf, imgData, uvrDat, roiname, timeStr, chunks, dataframeAppend)
+
+def saveExpDataset(ds, filePath, **kwargs):
+    # write to netCDF; object (e.g. texture name) variables are stored as strings
+    ds = ds.copy()
+    for var in ds.variables:
+        if ds[var].dtype == object: ds[var] = ds[var].astype(str)
+    ds.to_netcdf(filePath, **kwargs)
+
+def openExpDataset(filePath, chunks=None, **kwargs):
+    # lazily open a saved experiment dataset, variables are only read when selected and accessed
+    # chunks (e.g. {} or {'volumes [s]': 10000}) returns dask-backed variables instead (requires dask)
+    return xr.open_dataset(filePath, chunks=chunks, **kwargs)
+
+def find_upticks(signal, smoothing=3, chunksize=2**20):
+    signal = signal[~np.isnan(signal)]
+    # first pass for the half maximum of the smoothed signal, second pass for its upward zero crossings
+    halfmax = np.max([np.max(smoothed) for _, smoothed in smoothedChunks(signal, smoothing, chunksize)])/2
+    positive_zero_crossings = []
+    prev = None
+    for start, smoothed in smoothedChunks(signal, smoothing, chunksize):
+        sign_changes = np.sign(smoothed-halfmax)
+        if prev is not None: sign_changes = np.r_[prev, sign_changes]
+        offset = start - 1 if prev is not None else start
+        positive_zero_crossings.append(np.where((sign_changes[:-1] < 0) & (sign_changes[1:] > 0))[0] + offset)
+        prev = sign_changes[-1:]
+    return np.concatenate(positive_zero_crossings)
 
 # def alignWithPdSignal(nidDf, threshold=0.1, noFrameDropCorrection=True):
 #     nidDf = nidDf.dropna().reset_index(drop=True).copy() #remove frames where no photodiode signal was logged
@@ -297,33 +422,36 @@ def find_upticks(signal, smoothing=3):
 #     return nidDf
 
 def alignWithPdSignal(nidDf, pdThresh=0.1, pdClip = [0.04, 0.12], noFrameDropCorrection=True, supressPDAlignmentPlot = True, lims=[0,100]):
-    # Drop NaNs and reset index for cleaner processing
-    nidDf = nidDf.dropna(subset=['pdFilt']).reset_index(drop=True).copy()
+    # Drop NaNs and reset index for cleaner processing (returns a new table)
+    nidDf = nidDf.dropna(subset=['pdFilt']).reset_index(drop=True)
 
     #clip the photodiode signal to a reasonable range
-    nidDf['pdFilt'] = np.clip(nidDf['pdFilt'], pdClip[0], pdClip[1])
+    nidDf['pdFilt'] = np.clip(nidDf['pdFilt'].values, pdClip[0], pdClip[1])
     
     # Find indices where pdsig crosses the threshold in either direction
-    dips = np.where(np.diff(nidDf['pdFilt'] > pdThresh) != 0)[0]
+    dips = thresholdCrossings(nidDf['pdFilt'].values, pdThresh, 'both')
     
     # Calculate frame correction based on the first crossing point
-    NcorrectionFrames = nidDf['frame'].iloc[dips[0]] - nidDf['frame'].iloc[0] + 1
+    frame = nidDf['frame'].values
+    NcorrectionFrames = frame[dips[0]] - frame[0] + 1
     print('Difference between first unity frame that starts logging photodiode values and first high photodiode frame:', NcorrectionFrames)
     
     # Align frames and apply the correction, clamping within frame range
-    nidDf['frameToAlign'] = np.clip(nidDf['frame'] - NcorrectionFrames, nidDf['frame'].min(), nidDf['frame'].max())
-    
-    # Define valid frames depending on the frame drop correction setting
-    validFrames = (np.unique(nidDf['frameToAlign']) if noFrameDropCorrection 
-                   else np.unique(nidDf['frameToAlign'].iloc[dips]))
+    frameMin, frameMax = nidDf['frame'].min(), nidDf['frame'].max()
+    frameToAlign = np.clip(frame - NcorrectionFrames, frameMin, frameMax)
     
     # Adjust frame alignment with forward fill for invalid frames
-    nidDf['frameToAlign'] = nidDf['frameToAlign'].where(nidDf['frameToAlign'].isin(validFrames)).ffill()
+    # (all frames are valid without frame drop correction, otherwise only frames at photodiode crossings)
+    if not noFrameDropCorrection:
+        filled, nInvalid = forwardFillInvalid(frameToAlign, np.unique(frameToAlign[dips]))
+        if nInvalid: frameToAlign = filled
+    nidDf['frameToAlign'] = frameToAlign
 
     if not supressPDAlignmentPlot:
         _, ax = plt.subplots(figsize=(3, 1))
-        ax.plot(nidDf['pdFilt'].values, label='Photodiode Signal')
-        ax.plot(dips, nidDf['pdFilt'].values[dips], 'ko')
+        vutils.plotEnvelope(ax, nidDf['pdFilt'].values, xlim=lims, label='Photodiode Signal')
+        dipsInLims = dips[np.searchsorted(dips, lims[0]):np.searchsorted(dips, lims[1], 'right')]
+        ax.plot(dipsInLims, nidDf['pdFilt'].values[dipsInLims], 'ko')
         ax.set_xlim(lims[0], lims[1])
         vutils.myAxisTheme(ax)
     
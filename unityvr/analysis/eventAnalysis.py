@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+import warnings
+
+## Event-triggered (peri-event) analysis of behaviour and imaging signals
+# Events are times (e.g. stimulus onsets from getStimEpochs, flight or volte starts from onsetTimes),
+# optionally per trial/fly (groupStr). Each signal is gathered into an (event x lag) matrix in one indexing step.
+
+# Events ..........................................................................
+
+def onsetTimes(df, col, timeStr='time', groupStr=None):
+    # times at which a boolean/indicator column (e.g. flight from flightSeg, voltes from extractVoltes) switches on
+    on = df[col].fillna(0).values.astype(bool)
+    start = on & ~np.r_[False, on[:-1]]
+    if groupStr is not None:
+        groups = df[groupStr].values
+        start = on & ~(np.r_[False, on[:-1]] & np.r_[False, groups[1:] == groups[:-1]])
+        return pd.DataFrame({groupStr: groups[start], timeStr: df[timeStr].values[start]})
+    return df[timeStr].values[start]
+
+def _eventsByGroup(events, groupStr, timeStr):
+    if groupStr is None: return None, np.asarray(events, dtype=float)
+    return events[groupStr].values, events[timeStr].values.astype(float)
+
+
+# Aligned matrices ................................................................
+
+def eventIndices(df, events, window=(-1, 2), dt=None, timeStr='time', groupStr=None):
+    # sample indices (and interpolation weights) of every event and lag into df
+    # dt=None: lags are whole samples around the sample nearest to each event (strided gather), lag = samples * median dt
+    # dt given: lags are a regular grid with spacing dt and values are linearly interpolated
+    # returns lags, lower index, upper index, weight of the upper sample and the validity mask (events x lags)
+    # events: array of times, or a DataFrame with groupStr and timeStr columns
+    egroups, etimes = _eventsByGroup(events, groupStr, timeStr)
+    time = df[timeStr].values.astype(float)
+
+    # row range of each event's group (df is expected to be sorted by time within each group)
+    if groupStr is None:
+        lo, hi = np.zeros(len(etimes), dtype=int), np.full(len(etimes), len(df))
+        segments = [(np.arange(len(etimes)), 0, len(df))]
+    else:
+        groups = df[groupStr].values
+        segments = []
+        lo, hi = np.zeros(len(etimes), dtype=int), np.zeros(len(etimes), dtype=int)
+        rows = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1], True])
+        for start, stop in zip(rows[:-1], rows[1:]):
+            sel = np.flatnonzero(egroups == groups[start])
+            lo[sel], hi[sel] = start, stop
+            segments.append((sel, start, stop))
+
+    if dt is None:
+        dtmed = np.nanmedian(np.diff(time))
+        nlags = np.arange(int(np.round(window[0]/dtmed)), int(np.round(window[1]/dtmed))+1)
+        lags = nlags*dtmed
+        center = np.zeros(len(etimes), dtype=int)
+        for sel, start, stop in segments:
+            t = time[start:stop]
+            i = np.searchsorted(t, etimes[sel])
+            left, right = np.maximum(i-1, 0), np.minimum(i, len(t)-1)
+            center[sel] = start + np.where(np.abs(etimes[sel]-t[left]) <= np.abs(t[right]-etimes[sel]), left, right)
+        ilo = center[:,None] + nlags[None,:]
+        valid = (ilo >= lo[:,None]) & (ilo < hi[:,None])
+        return lags, np.clip(ilo, 0, len(df)-1), np.clip(ilo, 0, len(df)-1), np.zeros(ilo.shape), valid
+
+    lags = np.arange(window[0], window[1] + dt/2, dt)
+    query = etimes[:,None] + lags[None,:]
+    iup = np.zeros(query.shape, dtype=int)
+    for sel, start, stop in segments:
+        iup[sel] = start + np.searchsorted(time[start:stop], query[sel], side='left')
+    valid = (iup >= lo[:,None]) & (iup < hi[:,None])
+    iup = np.clip(iup, 0, len(df)-1)
+    ilo = np.maximum(iup - 1, lo[:,None])
+    # queries before the first sample of a group
+    valid &= time[ilo] <= query
+    span = time[iup] - time[ilo]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w = np.where(span > 0, (query - time[ilo])/span, 1.0)
+    return lags, ilo, iup, w, valid
+
+def alignedMatrix(values, ilo, iup, w, valid, circular=False):
+    # (event x lag) matrix of a signal from eventIndices output; circular signals (radians) are interpolated on the circle
+    values = np.asarray(values, dtype=float)
+    if circular:
+        c = (1-w)*np.cos(values[ilo]) + w*np.cos(values[iup])
+        s = (1-w)*np.sin(values[ilo]) + w*np.sin(values[iup])
+        mat = np.arctan2(s, c)
+    else:
+        mat = (1-w)*values[ilo] + w*values[iup]
+    mat[~valid] = np.nan
+    return mat
+
+def eventTriggered(df, events, signals, window=(-1, 2), dt=None, timeStr='time', groupStr=None, circular=(),
+                   baseline=None):
+    # event-triggered averages of one or more signals (columns of df, e.g. posDf or expDf)
+    # circular: signals given in radians that are averaged as angles (mean direction, sem from circular std)
+    # baseline: (start, end) lag window whose mean is subtracted per event (linear signals)
+    # returns lags, a tidy DataFrame (signal, lag, mean, sem, n) and a dict of (event x lag) matrices per signal
+    if isinstance(signals, str): signals = [signals]
+    lags, ilo, iup, w, valid = eventIndices(df, events, window, dt, timeStr, groupStr)
+
+    mats, rows = {}, []
+    for sig in signals:
+        iscirc = sig in circular
+        mat = alignedMatrix(df[sig].values, ilo, iup, w, valid, iscirc)
+        n = np.sum(~np.isnan(mat), axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            if iscirc:
+                C, S = np.nanmean(np.cos(mat), axis=0), np.nanmean(np.sin(mat), axis=0)
+                mean = np.arctan2(S, C)
+                sem = np.sqrt(-2*np.log(np.hypot(C, S)))/np.sqrt(n)
+            else:
+                if baseline is not None:
+                    inbase = (lags >= baseline[0]) & (lags <= baseline[1])
+                    mat = mat - np.nanmean(np.where(inbase[None,:], mat, np.nan), axis=1, keepdims=True)
+                mean = np.nanmean(mat, axis=0)
+                sem = np.nanstd(mat, axis=0, ddof=1)/np.sqrt(n)
+        mats[sig] = mat
+        rows.append(pd.DataFrame({'signal': sig, 'lag': lags, 'mean': mean, 'sem': sem, 'n': n}))
+
+    return lags, pd.concat(rows, ignore_index=True), mats
@@ -6,7 +6,7 @@ import matplotlib.pyplot as plt
 from unityvr.analysis.utils import getTrajFigName
 from unityvr.viz import viz
 
-from scipy.special import i0, iv
+from scipy.special import i0, iv, i0e, i1e, expit
 from scipy.optimize import curve_fit
 import scipy.stats as sts
 
@@ -24,37 +24,108 @@ def sum_of_vonmises_pdf(x, mu1, mu2, kappa):
     V = 0.5*(vonmises_pdf(x, mu1, kappa)+vonmises_pdf(x, mu2, kappa))
     return V
 
-#function to fit data to the von mises pdf
-def fit_vonmises(degAngles, binwidth = 20, plot = False, plotsave=False, saveDir=None, uvrDat=None,MFev=2000):
-    # in degrees
+#inverse of A1(kappa) = I1(kappa)/I0(kappa), the mean resultant length of a von mises distribution
+def a1inv(R, niter=8):
+    R = np.asarray(R, dtype=float)
+    Rc = np.clip(R, 0, 1-1e-12)
+
+    #Best & Fisher (1981) approximation as starting point
+    kappa = np.where(Rc < 0.53, 2*Rc + Rc**3 + 5*Rc**5/6,
+                     np.where(Rc < 0.85, -0.4 + 1.39*Rc + 0.43/(1-Rc), 1/(Rc**3 - 4*Rc**2 + 3*Rc)))
+
+    #refine with Newton steps, A1'(k) = 1 - A1/k - A1^2
+    for _ in range(niter):
+        k = np.maximum(kappa, 1e-12)
+        A = i1e(k)/i0e(k)
+        kappa = np.maximum(k - (A - Rc)/(1 - A/k - A**2), 0)
+
+    kappa = np.where(R >= 1, np.inf, kappa)
+    return np.where(np.isnan(R), np.nan, kappa)
+
+#maximum likelihood fit of a von mises, vectorized over groups of angles (in radians)
+def vonmises_mle(angles, groups=None, ngroups=None):
+    if groups is None: groups = np.zeros(len(angles), dtype=int)
+    if ngroups is None: ngroups = groups.max()+1 if len(groups) else 0
+    n = np.bincount(groups, minlength=ngroups)
+    C = np.bincount(groups, np.cos(angles), minlength=ngroups)
+    S = np.bincount(groups, np.sin(angles), minlength=ngroups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        R = np.hypot(C, S)/n
+    mu = np.mod(np.arctan2(S, C), 2*np.pi)
+    return mu, a1inv(R)
+
+#EM fit of the equal-weight, shared-kappa mixture of two von mises (sum_of_vonmises_pdf), vectorized over groups
+def vonmises_mixture_em(angles, groups=None, ngroups=None, maxiter=500, tol=1e-8):
+    if groups is None: groups = np.zeros(len(angles), dtype=int)
+    if ngroups is None: ngroups = groups.max()+1 if len(groups) else 0
+    n = np.bincount(groups, minlength=ngroups)
+    cosx, sinx = np.cos(angles), np.sin(angles)
+
+    #initialize from the axial (doubled angle) mean direction
+    C2 = np.bincount(groups, np.cos(2*angles), minlength=ngroups)
+    S2 = np.bincount(groups, np.sin(2*angles), minlength=ngroups)
+    mu1 = np.arctan2(S2, C2)/2
+    mu2 = mu1 + np.pi
+    with np.errstate(invalid='ignore', divide='ignore'):
+        kappa = a1inv(np.hypot(C2, S2)/n)
+    kappa = np.where(np.isfinite(kappa), kappa, 1.0)
+
+    for _ in range(maxiter):
+        #E-step: responsibility of the first component
+        dl = kappa[groups]*(cosx*(np.cos(mu1)-np.cos(mu2))[groups] + sinx*(np.sin(mu1)-np.sin(mu2))[groups])
+        r1 = expit(dl)
+
+        #M-step
+        Cr1 = np.bincount(groups, r1*cosx, minlength=ngroups); Sr1 = np.bincount(groups, r1*sinx, minlength=ngroups)
+        Cr2 = np.bincount(groups, (1-r1)*cosx, minlength=ngroups); Sr2 = np.bincount(groups, (1-r1)*sinx, minlength=ngroups)
+        mu1new, mu2new = np.arctan2(Sr1, Cr1), np.arctan2(Sr2, Cr2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            kappanew = a1inv((np.hypot(Cr1, Sr1) + np.hypot(Cr2, Sr2))/n)
+
+        change = np.nanmax(np.abs(np.concatenate([np.angle(np.exp(1j*(mu1new-mu1))), np.angle(np.exp(1j*(mu2new-mu2))),
+                                                  np.nan_to_num(kappanew-kappa, posinf=0, neginf=0)])), initial=0)
+        mu1, mu2, kappa = mu1new, mu2new, kappanew
+        if change < tol: break
+
+    return np.mod(mu1, 2*np.pi), np.mod(mu2, 2*np.pi), kappa
+
+#histogram an angle distribution as fit_vonmises does (radians), returns bin centers and density
+def _heading_density(angles, binwidth):
+    numbins = int(2*np.pi/binwidth)
+    theta = np.linspace(0,2*np.pi,num=numbins+1)[:-1] + binwidth/2
+    p = np.histogram(angles,bins=numbins,density=True)[0]
+    return theta, p
+
+#goodness of fit of a fitted density against the histogram density
+def _gof(p, fit_func):
+    [ks, p_value] = sts.ks_2samp(p, fit_func)
+    sqd = np.sum(np.square(p-fit_func))
+    return ks, p_value, sqd
+
+def _fit(degAngles, binwidth=20, MFev=2000, method='curve_fit', verbose=True):
+    #core of fit_vonmises without plotting, angles in degree, binwidth in degree
+    #returns mu1, mu2 (None if unimodal), kappa in radians, ks, p_value, sqd, bimodal flag, and the histogram
 
     #width to radians
     binwidth = binwidth*np.pi/180
 
-    #number of bins
-    numbins = int(2*np.pi/binwidth)
-
     #convert to radians
     angles = degAngles*np.pi/180
 
     #get probability density and theta vector
-    theta = np.linspace(0,2*np.pi,num=numbins+1)[:-1] + binwidth/2
-    p = np.histogram(angles,bins=numbins,density=True)[0]
+    theta, p = _heading_density(angles, binwidth)
 
     headingPVAmag = np.abs(np.nanmean(np.exp(1j*theta)))
 
-    plt.figure(figsize = (9,2))
-    plt.step(theta*180/np.pi, p)
-
     #fit p as a function of theta
-    params, _ = curve_fit(vonmises_pdf, theta, p, bounds=([0,0],[2*np.pi,np.inf]),maxfev=MFev)
+    if method == 'mle':
+        params = np.concatenate(vonmises_mle(np.asarray(angles)))
+    else:
+        params, _ = curve_fit(vonmises_pdf, theta, p, bounds=([0,0],[2*np.pi,np.inf]),maxfev=MFev)
     fit_func = vonmises_pdf(theta, params[0], params[1])
 
-    #compute kolmogorov-smirnoff stat
-    [ks, p_value] = sts.ks_2samp(p, fit_func)
-
-    #compute squared difference from fit
-    sqd = np.sum(np.square(p-fit_func))
+    #compute kolmogorov-smirnoff stat and squared difference from fit
+    ks, p_value, sqd = _gof(p, fit_func)
 
     #decide whether distribution is unimodal
     notFit = ~np.any([p_value>0.1, headingPVAmag>0.5])
@@ -65,61 +136,225 @@ def fit_vonmises(degAngles, binwidth = 20, plot = False, plotsave=False, saveDir
     #if not unimodal:
     #fit p as a function of theta to a sum of vonmises
     if notFit:
-        params, _ = curve_fit(sum_of_vonmises_pdf, theta, p, bounds=([0,0,0],[2*np.pi,2*np.pi,np.inf]),maxfev=MFev)
+        if method == 'mle':
+            params = np.concatenate(vonmises_mixture_em(np.asarray(angles)))
+        else:
+            params, _ = curve_fit(sum_of_vonmises_pdf, theta, p, bounds=([0,0,0],[2*np.pi,2*np.pi,np.inf]),maxfev=MFev)
         fit_func = sum_of_vonmises_pdf(theta, params[0], params[1], params[2])
 
-        #compute kolmogorov-smirnoff stat
-        [ks, p_value] = sts.ks_2samp(p, fit_func)
-
-        #compute squared difference from fit
-        sqd = np.sum(np.square(p-fit_func))
+        ks, p_value, sqd = _gof(p, fit_func)
 
         #decide whether distribution is bimodal:
         neitherFit =  ~(p_value>0.1)
 
     if neitherFit:
-        print("Neither unimodal nor bimodal fit.")
+        if verbose: print("Neither unimodal nor bimodal fit.")
         mu1 = float("NaN")
         mu2 =  float("NaN")
         kappa = float("NaN")
         p_value =  float("NaN")
         sqd = float("NaN")
 
+    elif notFit:
+        mu1 = params[0]
+        mu2 = params[1]
+        kappa = params[2]
+
     else:
-        if notFit:
-            mu1 = params[0]
-            mu2 = params[1]
-            kappa = params[2]
+        mu1 = params[0]
+        mu2 = None
+        kappa = params[1]
 
-        else:
-            mu1 = params[0]
-            mu2 = None
-            kappa = params[1]
+    return mu1, mu2, kappa, ks, p_value, sqd, notFit, theta, p
+
+#function to fit data to the von mises pdf
+def fit_vonmises(degAngles, binwidth = 20, plot = False, plotsave=False, saveDir=None, uvrDat=None,MFev=2000, method='curve_fit'):
+    # in degrees
+    # method: 'curve_fit' (least squares fit to the histogram) or 'mle' (maximum likelihood on the angles)
+
+    mu1, mu2, kappa, ks, p_value, sqd, notFit, theta, p = _fit(degAngles, binwidth, MFev, method)
 
-        if plot:
-            if notFit: V = sum_of_vonmises_pdf(np.linspace(0,2*np.pi,num=50), mu1, mu2, kappa)
-            else: V = vonmises_pdf(np.linspace(0,2*np.pi,num=50), mu1, kappa)
+    if plot:
+        plt.figure(figsize = (9,2))
+        plt.step(theta*180/np.pi, p)
 
-            #plot 1
-            plt.plot(np.linspace(0,360,num=50), V, 'k-')
-            plt.xlabel(r"$\theta$")
+    if plot and np.isfinite(mu1):
+        if notFit: V = sum_of_vonmises_pdf(np.linspace(0,2*np.pi,num=50), mu1, mu2, kappa)
+        else: V = vonmises_pdf(np.linspace(0,2*np.pi,num=50), mu1, kappa)
 
-            if plotsave:
-                plt.savefig(getTrajFigName("fit_vonmises",saveDir,uvrDat.metadata))
+        #plot 1
+        plt.plot(np.linspace(0,360,num=50), V, 'k-')
+        plt.xlabel(r"$\theta$")
 
-            #plot 2
-            fig, ax = plt.subplots(subplot_kw={'projection': 'polar'})
-            ax.plot(mu1, kappa, 'ro', alpha=0.5)
-            if notFit:
-                ax.plot(mu2, kappa, 'bo', alpha=0.5)
-            ax.set_yticks([0.5,1])
-            ax.set_theta_zero_location("E")
-            ax.set_xticks(np.pi/180 * np.arange(-180,  180,  45))
-            ax.set_thetalim(-np.pi, np.pi);
+        if plotsave:
+            plt.savefig(getTrajFigName("fit_vonmises",saveDir,uvrDat.metadata))
 
-            if plotsave:
-                fig.savefig(getTrajFigName("mu_kappa",saveDir,uvrDat.metadata))
+        #plot 2
+        fig, ax = plt.subplots(subplot_kw={'projection': 'polar'})
+        ax.plot(mu1, kappa, 'ro', alpha=0.5)
+        if notFit:
+            ax.plot(mu2, kappa, 'bo', alpha=0.5)
+        ax.set_yticks([0.5,1])
+        ax.set_theta_zero_location("E")
+        ax.set_xticks(np.pi/180 * np.arange(-180,  180,  45))
+        ax.set_thetalim(-np.pi, np.pi);
 
-            #returns mu in degree
+        if plotsave:
+            fig.savefig(getTrajFigName("mu_kappa",saveDir,uvrDat.metadata))
 
+    #returns mu in degree
     return mu1*180/np.pi, mu2*180/np.pi if mu2 is not None else mu2, kappa, ks, p_value, sqd
+
+
+fitColumns = ['mu1', 'mu2', 'kappa', 'ks', 'p_value', 'sqd']
+
+def _fit_batch_mle(degAngleList, binwidth=20):
+    #vectorized maximum likelihood fits of many angle distributions (in degree), no plotting
+    fits = np.nan*np.ones((len(degAngleList), len(fitColumns)))
+    bwrad = binwidth*np.pi/180
+
+    angles = [np.asarray(a, dtype=float)*np.pi/180 for a in degAngleList]
+    angles = [a[np.isfinite(a)] for a in angles]
+    valid = np.array([len(a) > 1 for a in angles], dtype=bool)
+    if not np.any(valid): return fits
+    ind = np.flatnonzero(valid)
+    flat = np.concatenate([angles[i] for i in ind])
+    groups = np.repeat(np.arange(len(ind)), [len(angles[i]) for i in ind])
+
+    #unimodal fits for all distributions at once
+    mu, kappa = vonmises_mle(flat, groups, len(ind))
+    densities = [_heading_density(angles[i], bwrad) for i in ind]
+    gof = np.array([_gof(p, vonmises_pdf(theta, m, k)) for (theta, p), m, k in zip(densities, mu, kappa)])
+    headingPVAmag = np.abs(np.nanmean(np.exp(1j*densities[0][0])))
+    notFit = ~((gof[:,1] > 0.1) | (headingPVAmag > 0.5))
+
+    fits[ind,0] = mu
+    fits[ind,2] = kappa
+    fits[ind,3:] = gof
+
+    #bimodal fits only for the distributions that are not unimodal
+    if np.any(notFit):
+        sub = np.flatnonzero(notFit)
+        subsel = np.isin(groups, sub)
+        relabel = np.cumsum(notFit)-1
+        mu1, mu2, kappa2 = vonmises_mixture_em(flat[subsel], relabel[groups[subsel]], len(sub))
+        gof2 = np.array([_gof(densities[j][1], sum_of_vonmises_pdf(densities[j][0], m1, m2, k))
+                         for j, m1, m2, k in zip(sub, mu1, mu2, kappa2)])
+        fits[ind[sub],0] = mu1
+        fits[ind[sub],1] = mu2
+        fits[ind[sub],2] = kappa2
+        fits[ind[sub],3:] = gof2
+
+        #neither unimodal nor bimodal
+        neither = ~(gof2[:,1] > 0.1)
+        fits[np.ix_(ind[sub][neither], [0,1,2,4,5])] = np.nan
+
+    fits[:,:2] *= 180/np.pi
+    return fits
+
+def _fit_batch_chunk(degAngleList, binwidth=20, method='mle', MFev=2000):
+    if method == 'mle': return _fit_batch_mle(degAngleList, binwidth)
+
+    fits = np.nan*np.ones((len(degAngleList), len(fitColumns)))
+    for i, a in enumerate(degAngleList):
+        a = np.asarray(a, dtype=float)
+        a = a[np.isfinite(a)]
+        if len(a) < 2: continue
+        mu1, mu2, kappa, ks, p_value, sqd, _, _, _ = _fit(a, binwidth, MFev, method, verbose=False)
+        fits[i] = [mu1*180/np.pi, mu2*180/np.pi if mu2 is not None else np.nan, kappa, ks, p_value, sqd]
+    return fits
+
+def fit_vonmises_batch(degAngles, binwidth=20, method='mle', MFev=2000, nprocs=1):
+    # fit many heading distributions (angles in degree) without plotting
+    # degAngles: list/dict/Series of angle arrays, e.g. posDf.groupby('trial')['angle']
+    # method: 'mle' (vectorized maximum likelihood + EM for the bimodal model) or 'curve_fit' (as fit_vonmises)
+    # nprocs > 1 splits the distributions across a process pool
+    # returns a DataFrame with mu1, mu2 (NaN if unimodal) in degree, kappa, ks, p_value, sqd per distribution
+
+    if isinstance(degAngles, pd.core.groupby.SeriesGroupBy):
+        degAngles = {k: g.values for k, g in degAngles}
+    if isinstance(degAngles, (dict, pd.Series)):
+        index, degAngleList = [k for k, _ in degAngles.items()], [a for _, a in degAngles.items()]
+    else:
+        index, degAngleList = None, list(degAngles)
+
+    if nprocs > 1 and len(degAngleList) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        chunks = np.array_split(np.arange(len(degAngleList)), min(nprocs, len(degAngleList)))
+        with ProcessPoolExecutor(max_workers=nprocs) as executor:
+            futures = [executor.submit(_fit_batch_chunk, [degAngleList[i] for i in c], binwidth, method, MFev) for c in chunks]
+            fits = np.vstack([f.result() for f in futures])
+    else:
+        fits = _fit_batch_chunk(degAngleList, binwidth, method, MFev)
+
+    return pd.DataFrame(fits, columns=fitColumns, index=index)
+
+
+def _ks_2samp_equal(p, q, pvalTable):
+    #row-wise two sample KS statistic between equally sized samples p and q (windows x bins)
+    #p-values are looked up from ks_2samp, which for equal sample sizes only depend on the statistic
+    n = p.shape[1]
+    vals = np.concatenate([p, q], axis=1)
+    order = np.argsort(vals, axis=1, kind='mergesort')
+    vals = np.take_along_axis(vals, order, axis=1)
+    steps = np.where(order < n, 1, -1)
+    cdfdiff = np.abs(np.cumsum(steps, axis=1))
+    #only evaluate the ecdf difference after the last of tied values
+    lastTie = np.ones(vals.shape, dtype=bool)
+    lastTie[:,:-1] = vals[:,1:] != vals[:,:-1]
+    k = np.max(cdfdiff*lastTie, axis=1)
+    return k/n, pvalTable[k]
+
+def fit_vonmises_sliding(posDf, window, stride=1, binwidth=20, angleStr='angle', timeStr='time'):
+    # time-resolved maximum likelihood von mises fits of heading (in degree) in sliding windows
+    # window and stride are in samples; histograms use int(360/binwidth) equal bins over [0, 360)
+    # (the bin width is adjusted to divide 360), whereas fit_vonmises bins over the range of the data,
+    # so ks, p_value and sqd are only comparable between windows, not with fit_vonmises
+    # window histograms and cos/sin sums are updated incrementally, so the cost is O(T + windows*bins)
+    # returns a DataFrame with the window center time, mu (degree), kappa, ks, p_value, sqd and n per window
+
+    angles = posDf[angleStr].values*np.pi/180
+    T = len(angles)
+    starts = np.arange(0, T-window+1, stride)
+    nwin = len(starts)
+
+    valid = np.isfinite(angles)
+    numbins = int(2*np.pi/(binwidth*np.pi/180))
+    binwidth = 2*np.pi/numbins
+    theta = np.linspace(0,2*np.pi,num=numbins+1)[:-1] + binwidth/2
+    bins = np.clip((np.mod(angles[valid], 2*np.pi)/(2*np.pi)*numbins).astype(int), 0, numbins-1)
+
+    #window histograms: each sample enters window ceil((i-window+1)/stride) and leaves after floor(i/stride)
+    ind = np.flatnonzero(valid)
+    wfirst = np.maximum(-((window-1-ind)//stride), 0)
+    wlast = np.minimum(ind//stride, nwin-1)
+    inwin = wfirst <= wlast
+    counts = np.zeros((nwin+1, numbins))
+    np.add.at(counts, (wfirst[inwin], bins[inwin]), 1)
+    np.add.at(counts, (wlast[inwin]+1, bins[inwin]), -1)
+    counts = np.cumsum(counts, axis=0)[:-1]
+
+    #window cos/sin sums from running sums
+    cumC = np.concatenate([[0], np.cumsum(np.where(valid, np.cos(angles), 0))])
+    cumS = np.concatenate([[0], np.cumsum(np.where(valid, np.sin(angles), 0))])
+    C = cumC[starts+window] - cumC[starts]
+    S = cumS[starts+window] - cumS[starts]
+    n = counts.sum(axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mu = np.mod(np.arctan2(S, C), 2*np.pi)
+        kappa = a1inv(np.hypot(C, S)/n)
+        p = counts/(n[:,None]*binwidth)
+        fit_func = vonmises_pdf(theta[None,:], mu[:,None], kappa[:,None])
+
+    #goodness of fit as in fit_vonmises
+    pvalTable = np.array([sts.ks_2samp(np.arange(numbins), np.arange(numbins)+k)[1] for k in range(numbins+1)])
+    ks, p_value = _ks_2samp_equal(p, fit_func, pvalTable)
+    sqd = np.sum(np.square(p-fit_func), axis=1)
+
+    empty = n == 0
+    ks[empty] = np.nan; p_value[empty] = np.nan
+
+    center = starts + window//2
+    return pd.DataFrame({timeStr: posDf[timeStr].values[center] if timeStr in posDf else center,
+                         'mu': mu*180/np.pi, 'kappa': kappa, 'ks': ks, 'p_value': p_value, 'sqd': sqd, 'n': n})
@@ -4,6 +4,8 @@ import matplotlib.patches as ppatch
 import warnings
 import pandas as pd
 from scipy.stats import circmean
+from functools import lru_cache
+from dataclasses import dataclass, field
 
 
 # Functions related to characterizing bump position .......................................
@@ -35,53 +37,87 @@ def computeVectorPVA(angle, weights):
     return pva, pvaLen
 
 ## Description of the (EB) bump related functions
+def getRoiNames(df, roiname = 'slice'):
+    return [key for key in df.keys() if roiname in key ]
+
 def getRoiNum(df, roiname = 'slice'):
-    roinames = [key for key in df.keys() if roiname in key ]
-    return len(roinames)
+    return len(getRoiNames(df, roiname))
+
+
+@lru_cache(maxsize=None)
+def getPVABasis(nroi, dtype='float64'):
+    """ cos/sin basis (nroi x 2) of the roi arc positions, computed once per roi count
+    """
+    roiArcPos = np.linspace(0, 2*np.pi, nroi+1)[:-1]
+    basis = np.vstack((np.cos(roiArcPos), np.sin(roiArcPos))).T.astype(dtype)
+    basis.setflags(write=False)
+    return basis
 
 
 def computePVA(locs, weights):
     """ Compute population vector average
     """
     nsteps = weights.shape[0]
-    nvol = weights.shape[1]
-    pva_x = np.cos(np.reshape(np.tile(locs,nvol),[nvol,nsteps])).T*weights
-    pva_y = np.sin(np.reshape(np.tile(locs,nvol),[nvol,nsteps])).T*weights
+    basis = np.vstack((np.cos(locs), np.sin(locs)))
 
-    pva = np.vstack((sum(pva_x)/len(pva_x), sum(pva_y)/len(pva_x)))
+    pva = basis @ weights / nsteps
 
     return pva
 
 
-def getEBBumpPVA(df, roiname = 'slice'):
-    roinames = [key for key in df.keys() if roiname in key ]
-    nroi = len(roinames)
-
-    roiArcPos = np.linspace(0, 2*np.pi, nroi+1)[:-1]
-    roidat = df[roinames].values.T
+def computeBumpPVA(roidat, dtype='float32', chunksize=2**16):
+    """ Batched population vector average of (..., volumes x rois) dff data
+    roidat can be a single trial (volumes x rois) or stacked trials (trials x volumes x rois);
+    the PVA is a single matrix product with a cached cos/sin basis, computed in chunks of volumes.
+    Returns pvaRad and pvaLen with the leading shape of roidat.
+    """
+    roidat = np.asarray(roidat)
+    nroi = roidat.shape[-1]
+    flat = roidat.reshape(-1, nroi)
+    basis = getPVABasis(nroi, np.dtype(dtype).name)
 
-    pva = computePVA(roiArcPos,roidat)
+    pva = np.empty((len(flat), 2), dtype=dtype)
+    for c in range(0, len(flat), chunksize):
+        pva[c:c+chunksize] = flat[c:c+chunksize].astype(dtype, copy=False) @ basis / nroi
 
-    pvaRad = np.mod(np.arctan2(pva[1,:],pva[0,:]), 2*np.pi)
-    pvaLen = np.hypot(pva[0,:],pva[1,:])
+    pvaRad = np.mod(np.arctan2(pva[:,1],pva[:,0]), 2*np.pi)
+    pvaLen = np.hypot(pva[:,0],pva[:,1])
 
     # flip to account for conversion to right-handed reference frame
     pvaRad = np.pi*2 - pvaRad
 
+    return pvaRad.reshape(roidat.shape[:-1]), pvaLen.reshape(roidat.shape[:-1])
+
+
+def getEBBumpPVA(df, roiname = 'slice', roinames = None):
+    if roinames is None: roinames = getRoiNames(df, roiname)
+    nroi = len(roinames)
+
+    roiArcPos = np.linspace(0, 2*np.pi, nroi+1)[:-1]
+
+    pvaRad, pvaLen = computeBumpPVA(df[roinames].values, dtype='float64')
+
     return pvaRad, pvaLen, roiArcPos
 
 
 # get max bump
-def getMaxBumpPos(df, roiname='slice', order=3, window=7):
+def computeMaxBumpPos(roidat, order=3, window=7):
+    """ Batched position of the maximum roi, smoothed over volumes
+    roidat can be a single trial (volumes x rois) or stacked trials (trials x volumes x rois)
+    """
     from scipy.signal import savgol_filter
-    roinames = [key for key in df.keys() if roiname in key ]
-
-    roidat = df[roinames].values
+    roidat = np.asarray(roidat)
 
-    maxbump = savgol_filter(np.argmax(roidat,axis=1), window, order)
+    maxbump = savgol_filter(np.argmax(roidat,axis=-1), window, order, axis=-1)
 
     # flip to account for conversion to right-handed reference frame
-    return len(roinames)-maxbump
+    return roidat.shape[-1]-maxbump
+
+
+def getMaxBumpPos(df, roiname='slice', order=3, window=7, roinames = None):
+    if roinames is None: roinames = getRoiNames(df, roiname)
+
+    return computeMaxBumpPos(df[roinames].values, order, window)
 
 
 def shiftPVA(pva,offset):
@@ -103,68 +139,175 @@ def findDFFPeaks(dff,radpos,dffth,minwidth=2):
 
     return peaks, peaksfilt
 
-def getOffsetCandidates(expDf,minwidth=4, useBrightAlignedAngle=True):
+def findDFFPeaksBatch(dff, dffth, minwidth=2, prominence=0.02, chunksize=2**13):
+    """ Find peaks in every row of a (time x position) dff array at once
+    Same criteria as findDFFPeaks: local maxima (plateaus resolved to their midpoint) with
+    prominence >= prominence, width at half prominence >= minwidth and dff > dffth.
+    Returns the row and column index of each peak, sorted by row and then column.
+    """
+    dff = np.asarray(dff, dtype='float')
+    n = dff.shape[1]
+    cols = np.arange(n)
+
+    # local maxima: a rise followed by a (possibly flat) fall, as in scipy.signal.find_peaks
+    d = np.diff(dff, axis=1)
+    nonzero = np.where(d != 0, np.arange(n-1), n-1)
+    nextNonzero = np.minimum.accumulate(nonzero[:,::-1], axis=1)[:,::-1]
+    rising = np.zeros(dff.shape, dtype='bool')
+    rising[:,1:-1] = d[:,:-1] > 0
+    rows, lefts = np.nonzero(rising)
+    ahead = nextNonzero[rows, lefts]
+    falls = ahead < n-1
+    falls[falls] = d[rows[falls], ahead[falls]] < 0
+    rows, peaks = rows[falls], (lefts[falls] + ahead[falls])//2
+
+    keep = np.zeros(len(peaks), dtype='bool')
+    for c in range(0, len(peaks), chunksize):
+        r, p = rows[c:c+chunksize], peaks[c:c+chunksize]
+        X = dff[r]
+        pv = X[np.arange(len(p)), p][:,None]
+        pc = p[:,None]
+
+        # prominence: lowest point on either side before reaching a higher sample
+        higher = X > pv
+        L = np.where(higher & (cols < pc), cols, -1).max(axis=1)[:,None]
+        R = np.where(higher & (cols > pc), cols, n).min(axis=1)[:,None]
+        leftRange = (cols > L) & (cols <= pc)
+        rightRange = (cols >= pc) & (cols < R)
+        leftMin = np.where(leftRange, X, np.inf).min(axis=1)[:,None]
+        rightMin = np.where(rightRange, X, np.inf).min(axis=1)[:,None]
+        leftBase = np.where(leftRange & (X == leftMin), cols, -1).max(axis=1)
+        rightBase = np.where(rightRange & (X == rightMin), cols, n).min(axis=1)
+        prom = pv[:,0] - np.maximum(leftMin, rightMin)[:,0]
+
+        # width at half prominence, with linear interpolation between samples
+        height = (pv[:,0] - prom*0.5)[:,None]
+        below = X <= height
+        il = np.maximum(leftBase, np.where(below & (cols <= pc), cols, -1).max(axis=1))
+        ir = np.minimum(rightBase, np.where(below & (cols >= pc), cols, n).min(axis=1))
+        ix = np.arange(len(p))
+        xl, xr = X[ix,il], X[ix,ir]
+        h = height[:,0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            leftIp = il + np.where(xl < h, (h - xl)/(X[ix,np.minimum(il+1,n-1)] - xl), 0)
+            rightIp = ir - np.where(xr < h, (h - xr)/(X[ix,np.maximum(ir-1,0)] - xr), 0)
+        width = rightIp - leftIp
+
+        keep[c:c+chunksize] = (prom >= prominence) & (width >= minwidth) & (pv[:,0] > dffth)
+
+    return rows[keep], peaks[keep]
+
+def getOffsetCandidateArrays(expDf,minwidth=4, useBrightAlignedAngle=True):
+    """ Batched offset candidate detection over all imaging volumes
+    Returns raw offsets, peak locations and peak dff as flat arrays over all detected peaks,
+    and framePtr such that the peaks of frame i are [framePtr[i]:framePtr[i+1]].
+    """
+    from scipy.signal import savgol_filter
+
     nroi = getRoiNum(expDf)
-    roidat = expDf[['slice{}'.format(i+1) for i in range(nroi)]]
+    roidat = expDf[['slice{}'.format(i+1) for i in range(nroi)]].to_numpy()
     tpts = len(roidat)
-    dffth = roidat.to_numpy().reshape(nroi*tpts,1).mean() #- roidat.to_numpy().reshape(nroi*tpts,1).std()/8
-
-    rawoffset = [None] * tpts
-    rawoffsetLoc = [None] * tpts
-    rawoffsetDFF = [None] * tpts
-    npeaks = np.zeros(tpts)
-    for i in range(tpts):
-        dff = roidat.loc[i,:].values
-        roiArcPos = getArcRadPos(nroi)
-        # pad by repeating once on each side
-        dff = np.hstack([dff,dff,dff])
-        radpos = np.hstack([roiArcPos-2*np.pi,roiArcPos,roiArcPos+2*np.pi])
-
-        # filter dff
-        from scipy.signal import savgol_filter
-        window = np.round(nroi/8)
-        if np.mod(window,2) == 0: window += 1
-        dff =  savgol_filter(dff, int(window), 3)
+    dffth = roidat.mean()
 
-        # flip to account for conversion to right-handed reference frame
-        radpos = np.pi*2 - radpos
+    # pad by repeating once on each side
+    roiArcPos = getArcRadPos(nroi)
+    dff = np.hstack([roidat,roidat,roidat])
+    radpos = np.hstack([roiArcPos-2*np.pi,roiArcPos,roiArcPos+2*np.pi])
 
-        # find DFF peaks
-        peaks, peaksfilt = findDFFPeaks(dff,radpos,dffth,minwidth)
+    # filter dff
+    window = np.round(nroi/8)
+    if np.mod(window,2) == 0: window += 1
+    dff = savgol_filter(dff, int(window), 3, axis=1)
 
-        #compute raw offsets and store them in a list of lists (list of frames, with list of raw offsets)
-        offsets = [None] * len(peaks)
-        for p in range(len(peaks)):
-            if useBrightAlignedAngle:
-                offsets[p] = circDist(radpos[peaks][p],expDf.angleBrightAligned.values[i]*np.pi/180)
-            else:
-                offsets[p] = circDist(radpos[peaks][p],expDf.angle.values[i]*np.pi/180)
+    # flip to account for conversion to right-handed reference frame
+    radpos = np.pi*2 - radpos
+
+    # find DFF peaks in all frames
+    frames, peaks = findDFFPeaksBatch(dff, dffth, minwidth)
+
+    # compute raw offsets
+    heading = expDf.angleBrightAligned.values if useBrightAlignedAngle else expDf.angle.values
+    rawoffset = (radpos[peaks] - heading[frames]*np.pi/180)%(np.pi*2)
+    rawoffset[rawoffset>np.pi] = rawoffset[rawoffset>np.pi] - 2*np.pi
+
+    framePtr = np.concatenate([[0], np.cumsum(np.bincount(frames, minlength=tpts))])
 
-        #filter peaks?
-        rawoffset[i] = offsets
-        rawoffsetLoc[i] = radpos[peaks]
-        rawoffsetDFF[i] = dff[peaks]
-    return rawoffset, rawoffsetLoc, rawoffsetDFF
+    return rawoffset, radpos[peaks], dff[frames,peaks], framePtr
+
+def getOffsetCandidates(expDf,minwidth=4, useBrightAlignedAngle=True):
+    # per-frame lists of raw offsets, peak locations and peak dff
+    rawoffset, rawoffsetLoc, rawoffsetDFF, framePtr = getOffsetCandidateArrays(expDf, minwidth, useBrightAlignedAngle)
+    split = framePtr[1:-1]
+    return np.split(rawoffset, split), np.split(rawoffsetLoc, split), np.split(rawoffsetDFF, split)
 
 
 def getArcRadPos(nroi, min=0, max=2*np.pi):
     return np.linspace(0, 2*np.pi, nroi+1)[:-1] +(np.pi/nroi)
 
 
-def getOffsetGroups(rawoffset, maxOffsetN=3, kernelfactordenom=1.5, peakwidth=2, peakheight=.1):
-    from scipy import stats as sts
+def circularKDE(angles, samplpts, bandwidth, nbins=2**10, images=None):
+    """ Gaussian KDE of angles (radians) on the circle
+    Angles are linearly binned (nbins points per 2pi) and convolved with a Gaussian of standard deviation
+    bandwidth via FFT; the density is evaluated at samplpts.
+    images=None: wrapped Gaussian, the density is periodic and samplpts can have any range.
+    images=k: the KDE of the angles and their copies shifted by +-2pi, ..., +-2k*pi (not periodic),
+    normalized per original angle, i.e. (2k+1) times a gaussian_kde of the duplicated angles.
+    """
+    angles = np.asarray(angles, dtype='float')
+    angles = angles[np.isfinite(angles)]
+
+    if images is not None:
+        from scipy.signal import fftconvolve
+        angles = (angles[:,None] + 2*np.pi*np.arange(-images, images+1)[None,:]).ravel()
+        samplpts = np.asarray(samplpts, dtype='float')
+
+        # linear binning on a grid covering the (shifted) angles and samplpts
+        h = 2*np.pi/nbins
+        lo = min(np.min(angles), np.min(samplpts)) - h
+        nb = int(np.ceil((max(np.max(angles), np.max(samplpts)) - lo)/h)) + 2
+        u = (angles-lo)/h
+        j = np.floor(u).astype('int')
+        frac = u-j
+        counts = np.bincount(j, weights=1-frac, minlength=nb) + np.bincount(j+1, weights=frac, minlength=nb)
+
+        # linear convolution with the gaussian sampled at all grid lags
+        lags = h*np.arange(-(nb-1), nb)
+        kernel = np.exp(-0.5*(lags/bandwidth)**2)/(np.sqrt(2*np.pi)*bandwidth)
+        density = fftconvolve(counts[:nb]*(2*images+1)/len(angles), kernel, mode='full')[nb-1:2*nb-1]
+
+        return np.interp(samplpts, lo + h*np.arange(nb), np.maximum(density, 0))
+
+    # linear binning on the circle
+    u = np.mod(angles+np.pi, 2*np.pi)/(2*np.pi)*nbins
+    j = np.floor(u).astype('int')
+    frac = u-j
+    counts = np.bincount(j%nbins, weights=1-frac, minlength=nbins) + np.bincount((j+1)%nbins, weights=frac, minlength=nbins)
+
+    # convolve with the wrapped gaussian, whose fourier coefficients are exp(-k^2 sigma^2/2)
+    k = np.arange(nbins//2+1)
+    density = np.fft.irfft(np.fft.rfft(counts/len(angles))*np.exp(-0.5*(k*bandwidth)**2), nbins)/(2*np.pi/nbins)
+
+    grid = np.linspace(-np.pi, np.pi, nbins+1)[:-1]
+    return np.interp(samplpts, grid, density, period=2*np.pi)
+
+
+def getOffsetGroups(rawoffset, maxOffsetN=3, kernelfactordenom=1.5, peakwidth=2, peakheight=.1, nbins=2**10):
     from scipy.signal import find_peaks
     # Use offset candidate histogram to estimate distribution (KDE) and find peaks
-    flat_list = np.asarray([item for sublist in rawoffset for item in sublist])
+    if isinstance(rawoffset, np.ndarray) and rawoffset.dtype != 'object':
+        flat_list = rawoffset
+    else:
+        flat_list = np.asarray([item for sublist in rawoffset for item in sublist])
 
-    #duplicate offset distribtion to avoid edge effects
-    offsets4kde = np.hstack([flat_list-np.pi*2, flat_list, flat_list+np.pi*2])
+    #bandwidth as for a gaussian_kde (scott's factor/kernelfactordenom) of the offsets duplicated at +-2pi
+    n = len(flat_list)
+    tripledvar = (3*np.sum((flat_list-flat_list.mean())**2) + 8*np.pi**2*n)/(3*n-1)
+    bandwidth = np.sqrt(tripledvar)*(3*n)**(-1/5)/kernelfactordenom
 
-    #estimate KDE on extended interval to avoid edge effects in peak detected
+    #estimate the KDE of the offsets duplicated at +-2pi on the extended interval to avoid edge effects in peak detected
+    #scaled by 1/3 to match the density of the duplicated offset distribution (as gaussian_kde of the tripled offsets)
     samplpts = np.linspace(-2*np.pi, 2*np.pi, 2**7)
-    kernel = sts.gaussian_kde(offsets4kde)
-    kernel.set_bandwidth(bw_method=kernel.factor / kernelfactordenom)
-    kdevals = kernel(samplpts)
+    kdevals = circularKDE(flat_list, samplpts, bandwidth, nbins, images=1)/3
 
     #find peaks in KDE
     kdepeaks, properties = find_peaks(kdevals,width=peakwidth,height=peakheight)
@@ -183,38 +326,62 @@ def getOffsetGroups(rawoffset, maxOffsetN=3, kernelfactordenom=1.5, peakwidth=2,
     return kdevals, samplpts, kdepeaks, kdeOffsets
 
 
-def groupOffsetCandidates(rawoffset,rawoffsetLoc,rawoffsetDFF, kdeOffsets, maxOffsetN=3):
+def rankWithinFrame(frames):
+    # position of each element within its frame, for frame indices sorted in ascending order
+    return np.arange(len(frames)) - np.searchsorted(frames, frames, side='left')
+
+
+def groupOffsetCandidates(rawoffset,rawoffsetLoc,rawoffsetDFF, kdeOffsets, maxOffsetN=3, framePtr=None):
     # Classify each frame's offset computed earlier as belonging to one of the peaks in the KDE distribution
-    tpts = len(rawoffset)
+    # takes per-frame lists, or flat arrays together with framePtr (see getOffsetCandidateArrays)
+    if framePtr is None:
+        framePtr = np.concatenate([[0], np.cumsum([len(r) for r in rawoffset])]).astype('int')
+        rawoffset, rawoffsetLoc, rawoffsetDFF = [np.concatenate([np.ravel(r) for r in x]+[[]]).astype('float')
+                                                 for x in (rawoffset, rawoffsetLoc, rawoffsetDFF)]
+    tpts = len(framePtr)-1
+    frames = np.repeat(np.arange(tpts), np.diff(framePtr))
+
     # initialize raw offset array: frame x offset stats  x offset number
     # offset stats: label, value, location, peak dff,
     offsetArray = np.nan * np.ones((tpts,4, maxOffsetN))
 
-    # convert raw offset to array, considering only unique values per frame
-    for t in range(tpts):
-        rawOffsetFrame = np.nan*np.ones(maxOffsetN)
-        tmp = np.unique(np.round(rawoffset[t],3))
-        rawOffsetFrame[:len(tmp)] = tmp[:min(maxOffsetN,len(tmp))]
-        loc = rawoffsetLoc[t][np.logical_and(rawoffsetLoc[t]>=0,rawoffsetLoc[t]<2*np.pi)]
-        dff = rawoffsetDFF[t][np.logical_and(rawoffsetLoc[t]>=0,rawoffsetLoc[t]<2*np.pi)]
-
-        if len(loc)==0: continue
-
-        # find which peak in kde the offsets correspond to
-        tmp1 = np.reshape(np.tile(kdeOffsets,maxOffsetN),(maxOffsetN,maxOffsetN))
-        tmp2 = np.reshape(np.tile(rawOffsetFrame,maxOffsetN),(maxOffsetN,maxOffsetN)).T
-        offsetDist = abs(circDist(tmp1,tmp2))
-        offsetDist[np.isnan(offsetDist)] = np.inf
-        labs = offsetDist.argmin(axis=1)[:len(tmp)]
-
-        if not len(loc) == len(labs):
-            labs = labs[:len(loc)]
-
-        for i,l in enumerate(labs):
-            offsetArray[t,0,l] = l
-            offsetArray[t,1,l] = rawOffsetFrame[i]
-            offsetArray[t,2,l] = loc[i]
-            offsetArray[t,3,l] = dff[i]
+    # convert raw offsets to a padded (frame x maxOffsetN) array, considering only unique values per frame
+    rounded = np.round(rawoffset,3)
+    order = np.lexsort((rounded, frames))
+    uf, uv = frames[order], rounded[order]
+    new = np.ones(len(uf), dtype='bool')
+    new[1:] = (uf[1:] != uf[:-1]) | ~((uv[1:] == uv[:-1]) | (np.isnan(uv[1:]) & np.isnan(uv[:-1])))
+    uf, uv = uf[new], uv[new]
+    rank = rankWithinFrame(uf)
+    rawOffsetFrame = np.nan*np.ones((tpts,maxOffsetN))
+    rawOffsetFrame[uf[rank<maxOffsetN], rank[rank<maxOffsetN]] = uv[rank<maxOffsetN]
+    nunique = np.bincount(uf, minlength=tpts)
+
+    # peak locations and dff within one revolution, padded in the same way
+    inrange = np.logical_and(rawoffsetLoc>=0,rawoffsetLoc<2*np.pi)
+    lf = frames[inrange]
+    rank = rankWithinFrame(lf)
+    loc = np.nan*np.ones((tpts,maxOffsetN))
+    dff = np.nan*np.ones((tpts,maxOffsetN))
+    loc[lf[rank<maxOffsetN], rank[rank<maxOffsetN]] = rawoffsetLoc[inrange][rank<maxOffsetN]
+    dff[lf[rank<maxOffsetN], rank[rank<maxOffsetN]] = rawoffsetDFF[inrange][rank<maxOffsetN]
+    nlabs = np.minimum(np.minimum(nunique, maxOffsetN), np.bincount(lf, minlength=tpts))
+
+    # find which peak in kde the offsets correspond to
+    offsetDist = np.mod(np.unwrap(kdeOffsets)[None,None,:] - rawOffsetFrame[:,:,None], np.pi*2)
+    offsetDist[offsetDist>np.pi] = offsetDist[offsetDist>np.pi] - 2*np.pi
+    offsetDist = abs(offsetDist)
+    offsetDist[np.isnan(offsetDist)] = np.inf
+    labs = offsetDist.argmin(axis=2)
+
+    # scatter into the offset array, later offsets overwrite earlier ones with the same label
+    for i in range(maxOffsetN):
+        t = np.where(nlabs>i)[0]
+        l = labs[t,i]
+        offsetArray[t,0,l] = l
+        offsetArray[t,1,l] = rawOffsetFrame[t,i]
+        offsetArray[t,2,l] = loc[t,i]
+        offsetArray[t,3,l] = dff[t,i]
     npeaks = np.sum(np.isfinite(offsetArray[:,0,:]),axis=1)
 
     return offsetArray, npeaks
@@ -222,7 +389,7 @@ def groupOffsetCandidates(rawoffset,rawoffsetLoc,rawoffsetDFF, kdeOffsets, maxOf
 
 def getOffsetFromDFFPeaks(expDf, maxOffsetN=3, minwidth=4, peakheight=.02, peakwidth=5):
     # (1) Find peaks in DFF distributions and (2) compute raw offsets
-    rawoffset, rawoffsetLoc, rawoffsetDFF = getOffsetCandidates(expDf, minwidth=minwidth)
+    rawoffset, rawoffsetLoc, rawoffsetDFF, framePtr = getOffsetCandidateArrays(expDf, minwidth=minwidth)
 
     # (3) Create histogram, (4) perform KDE and (5) find peaks**
     kdevals, samplpts, kdepeaks, kdeOffsets = getOffsetGroups(rawoffset,maxOffsetN,kernelfactordenom=1.5,\
@@ -231,9 +398,12 @@ def getOffsetFromDFFPeaks(expDf, maxOffsetN=3, minwidth=4, peakheight=.02, peakw
     # (6) Classify each frame's offset computed earlier as belonging to one or multiple peaks KDE distribution
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        offsetArray, npeaks= groupOffsetCandidates(rawoffset,rawoffsetLoc,rawoffsetDFF, kdeOffsets,maxOffsetN)
+        offsetArray, npeaks= groupOffsetCandidates(rawoffset,rawoffsetLoc,rawoffsetDFF, kdeOffsets,maxOffsetN,framePtr=framePtr)
         # offset array has dimensions time x properties (label, offsetvalue, locvalue, dff value) x offsetlabel
 
+    # raw offsets are returned per frame
+    rawoffset = np.split(rawoffset, framePtr[1:-1])
+
     return(rawoffset, kdevals, samplpts,kdepeaks, kdeOffsets, offsetArray, npeaks)
 
 
@@ -254,15 +424,14 @@ def makePeakNumberDf(npeaks, fly, condition, condname, trial):
 
 def findMainOffset(offsetArray,maxOffsetN):
     # find main offset based on dff amplitude
-    mainoffsetval = np.nan*np.ones(offsetArray.shape[0])
-    mainoffsetdff = np.nan*np.ones(offsetArray.shape[0])
-    mainoffsetid = np.nan*np.ones(offsetArray.shape[0])
-    for ts in range(offsetArray.shape[0]):
-        if sum(np.isnan(offsetArray[ts,3,:])) == maxOffsetN:
-            continue
-        mainoffsetid[ts] = np.nanargmax(offsetArray[ts,3,:])
-        mainoffsetval[ts] = offsetArray[ts,1,np.nanargmax(offsetArray[ts,3,:])]
-        mainoffsetdff[ts] = offsetArray[ts,3,np.nanargmax(offsetArray[ts,3,:])]
+    peakdff = offsetArray[:,3,:maxOffsetN]
+    empty = np.all(np.isnan(peakdff), axis=1)
+    mainid = np.where(np.isnan(peakdff), -np.inf, peakdff).argmax(axis=1)
+    t = np.arange(offsetArray.shape[0])
+
+    mainoffsetid = np.where(empty, np.nan, mainid)
+    mainoffsetval = np.where(empty, np.nan, offsetArray[t,1,mainid])
+    mainoffsetdff = np.where(empty, np.nan, offsetArray[t,3,mainid])
     return mainoffsetid, mainoffsetval, mainoffsetdff
 
 
@@ -327,6 +496,77 @@ def makeOffsetStatsDf(offsetTimeSeries, maxOffsetN, flies, conditions, condnames
                 offsetStatsFull = pd.concat([offsetStatsFull,statsdf])
     return offsetStatsFull
 
+# Online bump tracking ..........................................................
+@dataclass
+class onlineBumpTracker:
+    """ Incremental bump phase and offset tracker for closed-loop imaging
+    Call update with one volume of roi dff and the current heading (degrees); each update is O(nroi).
+    The offset estimate is an exponentially weighted circular mean of the per-volume offsets
+    (weight alpha per new volume, optionally scaled by the PVA length of that volume).
+    """
+    nroi: int
+    alpha: float = 0.02
+    weightByPVALen: bool = False
+
+    # running state
+    nvol: int = field(init=False, default=0)
+    pvaRad: float = field(init=False, default=np.nan)
+    pvaLen: float = field(init=False, default=np.nan)
+    offset: float = field(init=False, default=np.nan)
+    offsetEst: float = field(init=False, default=np.nan)
+    offsetStrength: float = field(init=False, default=np.nan)
+    _C: float = field(init=False, default=0.0)
+    _S: float = field(init=False, default=0.0)
+    _W: float = field(init=False, default=0.0)
+
+    def update(self, dff, heading):
+        basis = getPVABasis(self.nroi)
+        pva = np.asarray(dff, dtype='float') @ basis / self.nroi
+
+        # flip to account for conversion to right-handed reference frame
+        self.pvaRad = np.pi*2 - np.mod(np.arctan2(pva[1],pva[0]), 2*np.pi)
+        self.pvaLen = np.hypot(pva[0],pva[1])
+        self.offset = circDist(self.pvaRad, heading*np.pi/180)
+        self.nvol += 1
+
+        if np.isfinite(self.offset) and np.isfinite(self.pvaLen):
+            w = self.alpha*(self.pvaLen if self.weightByPVALen else 1)
+            self._C = (1-self.alpha)*self._C + w*np.cos(self.offset)
+            self._S = (1-self.alpha)*self._S + w*np.sin(self.offset)
+            self._W = (1-self.alpha)*self._W + w
+            self.offsetEst = np.arctan2(self._S, self._C)
+            self.offsetStrength = np.hypot(self._C, self._S)/self._W if self._W > 0 else np.nan
+
+        return self.pvaRad, self.pvaLen, self.offsetEst, self.offsetStrength
+
+
+def replayBumpTracker(expDf, roiname='slice', headingStr='angleBrightAligned', rate=None, timeStr='posTime', **trackerKwargs):
+    # replay an aligned recording (e.g. roiDFF.csv combined with posDf) volume by volume through an onlineBumpTracker
+    # if rate (volumes/s) is given, volumes are fed at that rate to mimic acquisition
+    # latency: time from the arrival of a volume (scheduled by rate) until its update is done
+    import time as systime
+
+    roinames = getRoiNames(expDf, roiname)
+    tracker = onlineBumpTracker(nroi=len(roinames), **trackerKwargs)
+    roidat = expDf[roinames].values
+    heading = expDf[headingStr].values
+
+    tracked = np.nan*np.ones((len(expDf),6))
+    tstart = systime.perf_counter()
+    for i in range(len(expDf)):
+        arrival = systime.perf_counter()
+        if rate is not None:
+            arrival = tstart + i/rate
+            systime.sleep(max(0, arrival - systime.perf_counter()))
+        tracked[i,:4] = tracker.update(roidat[i], heading[i])
+        tracked[i,4] = tracker.offset
+        tracked[i,5] = systime.perf_counter() - arrival
+
+    trackDf = pd.DataFrame(tracked, columns=['pvaRad','pvaLen','offsetEst','offsetStrength','offset','latency'])
+    if timeStr in expDf: trackDf[timeStr] = expDf[timeStr].values
+    return trackDf
+
+
 # Calcium traces vizualization .................................................
 # Some ROI visualizations
 def plotDFFheatmap(ax, df, roiname='slice', lefthanded=False):
@@ -355,47 +595,44 @@ def addDFFColorbar(fig, cax, ax):
     cbar.set_label('$(F - F_0) / F_0$ (per ROI)')  # vertically oriented colorbar
 
 
-def relativeToLandmark(expDf,clutterDf, xynames = ('x','y')):
-    # Find closest landmark, compute heading relative to it
-
-    cDf = clutterDf.copy()
+def relativeToLandmark(expDf,clutterDf, xynames = ('x','y'), nNearest = 1):
+    # Find closest landmark(s), compute heading relative to it
+    # landmarks are indexed in a KD-tree and all time points are queried at once
+    # with nNearest > 1 the k-th closest landmark is stored in columns with suffix _k (k = 2..nNearest)
+    from scipy.spatial import cKDTree
 
     #fly positions
-    x = expDf[xynames[0]].values
-    y = expDf[xynames[1]].values
-
-    #landmark position
-    lm_x = np.zeros(len(expDf)); lm_y = np.zeros(len(expDf))
-
-    #landmark identity
-    closest = np.array(lm_x,dtype='object')
-    
-    #landmark distance
-    distance = np.array(lm_x,dtype='object')
-
-    for i in range(len(closest)):
-        cDf['dist'] = np.hypot(abs(cDf['px'].values-x[i]), abs(cDf['py'].values-y[i]))
-        loc = cDf.dist.idxmin()
-        try:
-            distance[i] = cDf.loc[loc,'dist']
-            closest[i] = cDf.loc[loc,'name']
-            lm_x[i] = cDf.loc[loc,'px']
-            lm_y[i] = cDf.loc[loc,'py']
-        except KeyError:
-            closest[i] = np.nan
-            lm_x[i] = np.nan
-            lm_y[i] = np.nan
-
-    #complex vector
-    vec = (lm_x-x) + 1j*(lm_y-y)
-
-    #derive relative angle
-    expDf['rel_angle'] = ((expDf['angle']-((np.angle(
-        vec)*180/np.pi)%360))+180)%360-180
-    #angle between -180 and 180
-    expDf['lm_x'] = lm_x
-    expDf['lm_y'] = lm_y
-    expDf['closest'] = closest
-    expDf['distance'] = distance
+    x = expDf[xynames[0]].values.astype('float')
+    y = expDf[xynames[1]].values.astype('float')
+    valid = np.isfinite(x) & np.isfinite(y)
+
+    #landmark positions and identities
+    lms = clutterDf[['px','py']].values.astype('float')
+    names = clutterDf['name'].values
+
+    dist = np.full((len(expDf),nNearest), np.inf)
+    ind = np.full((len(expDf),nNearest), len(lms))
+    if len(lms)>0:
+        d, i = cKDTree(lms).query(np.column_stack([x[valid],y[valid]]), k=nNearest)
+        dist[valid] = d.reshape(-1,nNearest)
+        ind[valid] = i.reshape(-1,nNearest)
+    found = ind < len(lms)
+
+    for k in range(nNearest):
+        suffix = '' if k == 0 else '_{}'.format(k+1)
+        lm_x = np.where(found[:,k], np.append(lms[:,0],np.nan)[ind[:,k]], np.nan)
+        lm_y = np.where(found[:,k], np.append(lms[:,1],np.nan)[ind[:,k]], np.nan)
+
+        #complex vector
+        vec = (lm_x-x) + 1j*(lm_y-y)
+
+        #derive relative angle
+        expDf['rel_angle'+suffix] = ((expDf['angle']-((np.angle(
+            vec)*180/np.pi)%360))+180)%360-180
+        #angle between -180 and 180
+        expDf['lm_x'+suffix] = lm_x
+        expDf['lm_y'+suffix] = lm_y
+        expDf['closest'+suffix] = np.where(found[:,k], np.append(names,np.nan).astype('object')[ind[:,k]], np.nan)
+        expDf['distance'+suffix] = np.where(found[:,k], dist[:,k], np.nan)
 
     return expDf
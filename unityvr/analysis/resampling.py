@@ -0,0 +1,177 @@
+import numpy as np
+import pandas as pd
+
+## Bootstrap confidence intervals and permutation tests for (circular) summary statistics
+# Resamples are drawn as index matrices (resamples x samples) and statistics are evaluated along the
+# last axis, so a chunk of resamples is processed in one vectorized call.
+# Chunks are seeded from a SeedSequence, so results depend on the seed but not on the number of processes.
+
+# Statistics ......................................................................
+# circular statistics expect radians, like circmean/circvar from scipy and astropy
+
+def circMean(angles, axis=-1):
+    return np.arctan2(np.nanmean(np.sin(angles), axis=axis), np.nanmean(np.cos(angles), axis=axis))
+
+def resultantLength(angles, axis=-1):
+    # PVA magnitude
+    return np.hypot(np.nanmean(np.sin(angles), axis=axis), np.nanmean(np.cos(angles), axis=axis))
+
+def circVar(angles, axis=-1):
+    # 1 - resultant length, as astropy.stats.circvar
+    return 1 - resultantLength(angles, axis)
+
+statistics = {
+    'circmean': circMean,
+    'resultant': resultantLength,
+    'circvar': circVar,
+    'mean': np.nanmean,
+    'median': np.nanmedian,
+    'std': np.nanstd,
+}
+
+# statistics of angles (converted from degrees with deg=True)
+angularStatistics = ['circmean', 'resultant', 'circvar']
+# statistics whose values are angles (differences and intervals are wrapped)
+circularStatistics = ['circmean']
+
+
+def getStatistic(statistic):
+    if callable(statistic): return statistic, False
+    if statistic not in statistics:
+        raise ValueError(f"Unknown statistic '{statistic}', use one of {list(statistics)} or a callable")
+    return statistics[statistic], statistic in circularStatistics
+
+def wrapAngle(angle):
+    return np.mod(angle + np.pi, 2*np.pi) - np.pi
+
+
+# Resampling ......................................................................
+
+def bootstrapIndices(n, nresample, rng):
+    # resample index matrix for bootstrapping (draw n out of n with replacement)
+    return rng.integers(0, n, size=(nresample, n))
+
+def permutationIndices(n, nresample, rng):
+    # index matrix of random permutations of n samples
+    return np.argsort(rng.random((nresample, n)), axis=1)
+
+def _chunkSizes(nresample, chunksize):
+    return [min(chunksize, nresample - i) for i in range(0, nresample, chunksize)]
+
+def _bootstrapChunk(data, statfunc, nresample, seed):
+    rng = np.random.default_rng(seed)
+    return statfunc(data[bootstrapIndices(len(data), nresample, rng)], axis=-1)
+
+def _permutationChunk(data, n1, statfunc, circular, nresample, seed):
+    rng = np.random.default_rng(seed)
+    perm = data[permutationIndices(len(data), nresample, rng)]
+    diff = statfunc(perm[:,:n1], axis=-1) - statfunc(perm[:,n1:], axis=-1)
+    return wrapAngle(diff) if circular else diff
+
+def getSeedSequence(seed):
+    # seed: None, int or SeedSequence
+    return seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+
+def _runChunks(chunkfunc, args, nresample, seed, nprocs, chunksize):
+    sizes = _chunkSizes(nresample, chunksize)
+    seeds = getSeedSequence(seed).spawn(len(sizes))
+    if nprocs > 1 and len(sizes) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=nprocs) as executor:
+            futures = [executor.submit(chunkfunc, *args, s, sd) for s, sd in zip(sizes, seeds)]
+            return np.concatenate([f.result() for f in futures])
+    return np.concatenate([chunkfunc(*args, s, sd) for s, sd in zip(sizes, seeds)])
+
+
+def bootstrapDistribution(data, statistic='mean', nboot=10000, seed=None, nprocs=1, chunksize=1000, deg=False):
+    # bootstrap distribution of a statistic, nboot resamples of the non-NaN data
+    # (angle-valued statistics in degrees with deg=True, see bootstrapCI)
+    statfunc, circular = getStatistic(statistic)
+    data = np.asarray(data, dtype=float)
+    data = data[~np.isnan(data)]
+    if deg and statistic in angularStatistics: data = np.deg2rad(data)
+
+    estimate = statfunc(data)
+    bootstat = _runChunks(_bootstrapChunk, (data, statfunc), nboot, seed, nprocs, chunksize)
+
+    # angle-valued statistics are returned in degrees, like bootstrapCI
+    if deg and circular: estimate, bootstat = np.rad2deg(estimate), np.rad2deg(bootstat)
+    return estimate, bootstat
+
+def bootstrapCI(data, statistic='mean', nboot=10000, ci=95, seed=None, nprocs=1, chunksize=1000, deg=False):
+    # percentile bootstrap confidence interval of a statistic of the non-NaN data
+    # statistic: name in statistics (circular statistics expect radians, or degrees with deg=True) or
+    # a callable that reduces along axis=-1
+    # circular intervals are computed on differences to the estimate and may wrap around +-pi
+    # returns estimate, lower and upper bound
+
+    statfunc, circular = getStatistic(statistic)
+    data = np.asarray(data, dtype=float)
+    data = data[~np.isnan(data)]
+    if deg and statistic in angularStatistics: data = np.deg2rad(data)
+
+    estimate = statfunc(data)
+    bootstat = _runChunks(_bootstrapChunk, (data, statfunc), nboot, seed, nprocs, chunksize)
+
+    alpha = (100 - ci)/2
+    if circular:
+        lo, hi = estimate + np.nanpercentile(wrapAngle(bootstat - estimate), [alpha, 100 - alpha])
+        lo, hi = wrapAngle(lo), wrapAngle(hi)
+    else:
+        lo, hi = np.nanpercentile(bootstat, [alpha, 100 - alpha])
+
+    if deg and circular: estimate, lo, hi = np.rad2deg([estimate, lo, hi])
+    return estimate, lo, hi
+
+def permutationTest(group1, group2, statistic='mean', nperm=10000, alternative='two-sided', seed=None, nprocs=1,
+                    chunksize=1000, deg=False):
+    # two-group permutation test for a difference of a statistic (group1 - group2) of the non-NaN data
+    # for circular statistics the difference is wrapped to [-pi, pi)
+    # alternative: 'two-sided', 'greater' or 'less'
+    # returns the observed difference and the p-value
+
+    statfunc, circular = getStatistic(statistic)
+    group1 = np.asarray(group1, dtype=float)
+    group2 = np.asarray(group2, dtype=float)
+    group1, group2 = group1[~np.isnan(group1)], group2[~np.isnan(group2)]
+    if deg and statistic in angularStatistics:
+        group1, group2 = np.deg2rad(group1), np.deg2rad(group2)
+
+    observed = statfunc(group1) - statfunc(group2)
+    if circular: observed = wrapAngle(observed)
+
+    data = np.concatenate([group1, group2])
+    permdiff = _runChunks(_permutationChunk, (data, len(group1), statfunc, circular), nperm, seed, nprocs, chunksize)
+
+    # small tolerance so that permutations reproducing the observed split count as extreme
+    tol = 1e-12*np.maximum(1, np.abs(observed))
+    if alternative == 'two-sided': extreme = np.abs(permdiff) >= np.abs(observed) - tol
+    elif alternative == 'greater': extreme = permdiff >= observed - tol
+    elif alternative == 'less': extreme = permdiff <= observed + tol
+    else: raise ValueError("alternative must be 'two-sided', 'greater' or 'less'")
+
+    p_value = (np.sum(extreme) + 1)/(nperm + 1)
+
+    if deg and circular: observed = np.rad2deg(observed)
+    return observed, p_value
+
+def compareGroups(df, valueStr, groupStr, statistic='mean', nboot=10000, nperm=10000, ci=95, seed=None, nprocs=1,
+                  deg=False):
+    # bootstrap CIs per group and pairwise permutation tests for a column of a (e.g. fit or offset stats) DataFrame
+    seeds = getSeedSequence(seed).spawn(2)
+    groups = list(df[groupStr].unique())
+    bootseeds = seeds[0].spawn(len(groups))
+
+    ciDf = pd.DataFrame([(g,) + bootstrapCI(df.loc[df[groupStr]==g, valueStr].values, statistic, nboot, ci, bs,
+                                            nprocs, deg=deg)
+                         for g, bs in zip(groups, bootseeds)],
+                        columns=[groupStr, 'estimate', 'ci_lo', 'ci_hi'])
+
+    pairs = [(g1, g2) for i, g1 in enumerate(groups) for g2 in groups[i+1:]]
+    permseeds = seeds[1].spawn(len(pairs))
+    permDf = pd.DataFrame([(g1, g2) + permutationTest(df.loc[df[groupStr]==g1, valueStr].values,
+                                                      df.loc[df[groupStr]==g2, valueStr].values,
+                                                      statistic, nperm, seed=ps, nprocs=nprocs, deg=deg)
+                           for (g1, g2), ps in zip(pairs, permseeds)],
+                          columns=['group1', 'group2', 'difference', 'p_value'])
+    return ciDf, permDf
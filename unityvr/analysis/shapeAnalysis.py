@@ -13,6 +13,7 @@ import matplotlib.pyplot as plt
 from unityvr.viz import viz
 from unityvr.analysis.utils import carryAttrs
 from unityvr.analysis.utils import getTrajFigName
+from unityvr.analysis.utils import rollingCircStats
 
 ##functions to derive and process shapeDf dataframe
 
@@ -30,41 +31,14 @@ def shape(posDf, step = None, interp='linear', stitch=False, plot = False, plots
             posDf = carryAttrs(posDf.loc[posDf['flight']==0], posDf)
             interp = 'nearest'
         if stitch:
-            df = posDf.where(posDf['flight']==0).copy()
-            
-            counter = 'count' if 'count' in posDf else 'frame'
-            
-            for i,fstart in enumerate(np.array(posDf[counter].loc[posDf['flight'].diff()==1])):
-                fstop = np.array(posDf[counter].loc[posDf['flight'].diff()==-1])[i]
-                df.loc[df[counter]>=fstop,'x'] += float(posDf.loc[posDf[counter]==fstart-1]['x'])-float(posDf.loc[posDf[counter]==fstop]['x'])
-                df.loc[df[counter]>=fstop,'y'] += float(posDf.loc[posDf[counter]==fstart-1]['y'])-float(posDf.loc[posDf[counter]==fstop]['y'])
-            posDf = carryAttrs(df.dropna(subset=['x','y']),posDf)
+            posDf = carryAttrs(stitchFlightBouts(posDf),posDf)
 
     # if the step length is not specified, choose the mean velocity of the fly
     if step is None:
         step = np.nanmean(posDf['ds'])
 
-    # get trajectory
-    points = np.array([posDf['x'].values,posDf['y'].values]).T
-    _,idx = np.unique(points,axis=0,return_index=True) #remove repeats
-    clean = np.array([points[i] for i in sorted(idx)])
-    time = np.array([posDf['time'].iloc[i] for i in sorted(idx)])
-    angle = np.array([posDf['angle'].iloc[i] for i in sorted(idx)])
-
-    # Linear length along the line:
-    distance = np.cumsum( np.sqrt(np.sum( np.diff(clean, axis=0)**2, axis=1 )) )
-    distance = np.insert(distance, 0, 0)/distance[-1]
-
-    # Interpolation for different methods:
-    alpha = np.linspace(0, 1, int(np.nanmax(posDf['s'])/step))
-
-    path_interpolator =  sp.interpolate.interp1d(distance, clean, kind=interp, axis=0)
-    time_interpolator = sp.interpolate.interp1d(distance, time, kind=interp,axis=0)
-    angle_interpolator = sp.interpolate.interp1d(distance, angle, kind=interp,axis=0)
-
-    shapeDf = pd.DataFrame(path_interpolator(alpha),columns = ['x','y'])
-    shapeDf['time'] = time_interpolator(alpha)
-    shapeDf['angle'] = angle_interpolator(alpha)
+    # resample the trajectory at equal pathlength steps
+    shapeDf = arcLengthResample(posDf, int(np.nanmax(posDf['s'])/step), columns=['time','angle'], interp=interp)
     shapeDf['dx'] = np.diff(shapeDf['x'],prepend=0)
     shapeDf['dy'] = np.diff(shapeDf['y'],prepend=0)
     shapeDf['ds'] = np.sqrt((shapeDf['dx']**2)+(shapeDf['dy']**2))
@@ -89,6 +63,51 @@ def shape(posDf, step = None, interp='linear', stitch=False, plot = False, plots
 
     return shapeDf
 
+#stitch the walking trajectory across flight bouts
+def stitchFlightBouts(posDf, counter=None):
+    #flight samples are dropped and every walking segment is offset so that it starts where the fly took off
+    if counter is None: counter = 'count' if 'count' in posDf else 'frame'
+
+    df = posDf.where(posDf['flight']==0)
+
+    fstarts = posDf[counter].values[(posDf['flight'].diff()==1).values]
+    fstops = posDf[counter].values[(posDf['flight'].diff()==-1).values][:len(fstarts)]
+    fstarts = fstarts[:len(fstops)]
+
+    #jump across each flight bout, looked up by counter value
+    xy = posDf.set_index(counter)[['x','y']]
+    jumps = xy.loc[fstarts-1].values - xy.loc[fstops].values
+
+    #every sample after a bout is offset by the jumps of all previous bouts
+    #jumps are added bout by bout (not as a summed correction) so that rounding, and thus de-duplication of landing samples, is unchanged
+    order = np.argsort(df[counter].values, kind='stable')
+    first = np.searchsorted(df[counter].values[order], fstops, side='left')
+    xy = df[['x','y']].values[order]
+    for f,jump in zip(first,jumps):
+        xy[f:] += jump
+    stitched = np.empty_like(xy); stitched[order] = xy
+    df['x'] = stitched[:,0]
+    df['y'] = stitched[:,1]
+
+    return df.dropna(subset=['x','y'])
+
+#resample columns of a trajectory at n points equally spaced in pathlength
+def arcLengthResample(posDf, n, columns=['time','angle'], interp='linear'):
+
+    #remove repeated positions, keeping the first visit
+    clean = posDf.loc[~posDf.duplicated(subset=['x','y']).values, ['x','y']+list(columns)]
+    vals = clean.values.astype('float')
+
+    # Linear length along the line:
+    distance = np.cumsum( np.sqrt(np.sum( np.diff(vals[:,:2], axis=0)**2, axis=1 )) )
+    distance = np.insert(distance, 0, 0)/distance[-1]
+
+    # single interpolation of all columns
+    alpha = np.linspace(0, 1, n)
+    interpolator = sp.interpolate.interp1d(distance, vals, kind=interp, axis=0)
+
+    return pd.DataFrame(interpolator(alpha), columns = ['x','y']+list(columns))
+
 #get pathlength
 def pathC(ds):
     ds = np.array(ds)
@@ -221,16 +240,9 @@ def extractVoltes(shapeDf, res_cm = 0.5, L_thresh_min_cm = 1 #in cm
                 ys.append(xs_ys[1])
                 ts.append([t[j],t[i]])
 
-    ts = np.array(ts)
+    ts = np.array(ts).reshape(-1,2)
 
-    con_net = np.zeros(np.shape(shapeDf['time'])).astype('bool')
-    for i in range(len(ts)):
-        con = (df['time']>=ts[i,0]) & (df['time']<=ts[i,1])
-        L = np.sum(shapeDf['ds'][con])
-        if (L>=L_thresh_min) & (L<=L_thresh_max):
-            con_net = (con_net)|(con)
-
-    df['voltes'] = con_net
+    df['voltes'] = volteMask(df['time'].values, shapeDf['ds'].values, ts, L_thresh_min, L_thresh_max)
 
     df = carryAttrs(df, shapeDf)
     
@@ -242,6 +254,30 @@ def extractVoltes(shapeDf, res_cm = 0.5, L_thresh_min_cm = 1 #in cm
 
     return df
 
+def volteMask(time, ds, ts, L_thresh_min, L_thresh_max):
+    #marks every sample that lies within a [t0,t1] interval of ts whose pathlength is within the thresholds
+    #intervals are located with searchsorted on the sorted time axis, so time does not need to be monotonic
+
+    order = np.argsort(time, kind='stable')
+    tsorted = time[order]
+    lo = np.searchsorted(tsorted, ts[:,0], side='left')
+    hi = np.searchsorted(tsorted, ts[:,1], side='right')
+
+    #pathlength within each interval from the cumulative pathlength, nan steps count as 0 (like np.sum over a Series)
+    dsorted = ds[order]
+    S = np.concatenate([[0], np.cumsum(np.where(np.isfinite(dsorted), dsorted, 0))])
+    L = S[hi]-S[lo]
+    accept = (hi>lo) & (L>=L_thresh_min) & (L<=L_thresh_max)
+
+    #union of accepted intervals through a difference array
+    diff = np.zeros(len(time)+1, dtype='int')
+    np.add.at(diff, lo[accept], 1)
+    np.add.at(diff, hi[accept], -1)
+
+    mask = np.zeros(len(time), dtype='bool')
+    mask[order] = np.cumsum(diff[:-1])>0
+    return mask
+
 def fixationClassify(shapeDf,
                     window_size = 10, #cm
                     front_lims = [-np.pi/4,np.pi/4],
@@ -254,8 +290,7 @@ def fixationClassify(shapeDf,
     
     df = shapeDf.copy()
     
-    df['pva_angle'] = df['angle'].rolling(w,center=True).apply(lambda x: np.angle(np.mean(np.exp(1j*np.deg2rad(x)))))
-    df['pva_mag'] = df['angle'].rolling(w,center=True).apply(lambda x: np.abs(np.mean(np.exp(1j*np.deg2rad(x)))))
+    df['pva_angle'], df['pva_mag'] = rollingCircStats(df['angle'].values, w, center=True)
     
     neg = (df['pva_angle']>=front_lims[0])&(df['pva_angle']<=front_lims[1])
     pos = (df['pva_angle']<=back_lims[0])|(df['pva_angle']>=back_lims[1])
@@ -276,29 +311,55 @@ def fixationClassify(shapeDf,
 
 def shapeToTime(posDf,shapeDf,label,new_name=None,enforce_nearest=False):
     
-    data_type = shapeDf.dtypes[label]
-    if ((data_type == 'bool')|(enforce_nearest==True)):
-        interp_type = 'int'
-        interp_kind = 'nearest'
-        #fill = 0
-    else:
-        interp_type = data_type
-        interp_kind = 'linear'
-        #fill = float("NaN")
-    
-    pDf = posDf.copy()
-
-    transform = sp.interpolate.interp1d(shapeDf['time'],shapeDf[label].astype(interp_type),kind=interp_kind,bounds_error=False,fill_value="extrapolate")
-    
-    if new_name is None:
-        pDf[label] = transform(pDf['time']).astype(data_type)
-    else:
-        pDf[new_name] = transform(pDf['time']).astype(data_type)
+    pDf = shapeToTimeBatch(posDf.copy(), shapeDf, [label],
+                           new_names=None if new_name is None else [new_name],
+                           enforce_nearest=enforce_nearest)
 
     pDf = carryAttrs(pDf, posDf)
 
     return pDf
 
+def shapeToTimeIndex(shapeTime, time):
+    #precompute the shape->time mapping once (same conventions as interp1d with fill_value="extrapolate")
+    order = np.argsort(shapeTime, kind='mergesort')
+    x = np.asarray(shapeTime, dtype='float')[order]
+
+    #nearest neighbour: midpoints between samples, ties go to the lower sample
+    nearest = np.searchsorted(x[1:]/2.0 + x[:-1]/2.0, time, side='left')
+    nearest = order[np.clip(nearest, 0, len(x)-1)]
+
+    #linear: bracketing samples, extrapolated from the first/last pair
+    hi = np.clip(np.searchsorted(x, time), 1, len(x)-1)
+    lo = hi-1
+    dx = x[hi]-x[lo]
+    dxnew = time-x[lo]
+
+    return {'nearest': nearest, 'lo': order[lo], 'hi': order[hi], 'dx': dx, 'dxnew': dxnew}
+
+def shapeToTimeBatch(posDf, shapeDf, labels, new_names=None, enforce_nearest=False, index=None):
+    #transfer several shapeDf columns to posDf at once, columns are added to posDf in place
+    #bool, categorical and object columns (and labels in enforce_nearest, or all labels if True) use nearest neighbour, numeric columns are linearly interpolated
+
+    if new_names is None: new_names = labels
+    if index is None: index = shapeToTimeIndex(shapeDf['time'].values, posDf['time'].values)
+
+    for label, name in zip(labels, new_names):
+        col = shapeDf[label]
+        data_type = col.dtype
+        nearest = enforce_nearest if isinstance(enforce_nearest, bool) else (label in enforce_nearest)
+
+        if isinstance(data_type, pd.CategoricalDtype):
+            posDf[name] = pd.Categorical.from_codes(col.cat.codes.values[index['nearest']], dtype=data_type)
+        elif nearest or (data_type == 'bool') or (data_type == 'object'):
+            posDf[name] = col.values[index['nearest']]
+        else:
+            y = col.values.astype('float')
+            ylo = y[index['lo']]
+            slope = (y[index['hi']]-ylo)/index['dx']
+            posDf[name] = (slope*index['dxnew'] + ylo).astype(data_type)
+
+    return posDf
+
 def number_of_voltes(shapeDf):
     return sp.ndimage.label(shapeDf['voltes'])[1]
 
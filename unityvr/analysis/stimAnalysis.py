@@ -1,7 +1,7 @@
 import xarray as xr
 
-from os.path import sep, exists
-from os import mkdir, makedirs, getcwd
+from os.path import sep, exists, abspath
+from os import mkdir, makedirs, getcwd, stat
 
 from scipy.signal import savgol_filter
 from scipy.ndimage import gaussian_filter
@@ -15,6 +15,27 @@ import ast
 
 from matplotlib import pyplot as plt
 
+def groupedStimVel(angle, groups, dt, std_filter=3, diskSize=5, round=-1):
+    # stimulus velocity for all textures at once: within texture diffs, std based removal of jumps,
+    # grey opening and closing and rounding, NaN where groups < 0
+    # textures of equal length are stacked as rows and filtered together with a 1 x diskSize footprint,
+    # which gives the same result as filtering each texture on its own
+    vel = np.nan*np.ones(len(angle))
+    order = np.argsort(groups, kind='stable')
+    order = order[groups[order] >= 0]
+    if len(order) == 0: return vel
+    g = groups[order]
+    starts = np.flatnonzero(np.r_[True, g[1:] != g[:-1]])
+    lengths = np.diff(np.r_[starts, len(g)])
+    footprint = np.ones((1,diskSize))
+
+    for L in np.unique(lengths):
+        idx = order[starts[lengths == L][:,None] + np.arange(L)]
+        v = np.diff(angle[idx], axis=1, prepend=np.nan)
+        v[np.abs(v)>(np.nanmean(v,axis=1)+std_filter*np.nanstd(v,axis=1))[:,None]] = 0
+        vel[idx] = np.round(ski.morphology.closing(ski.morphology.opening(v,footprint),footprint)/dt,round)
+    return vel
+
 def deriveTexVals(texDf, 
               std_filter = 3, #3*std deviation filter for removing large jumps
               diskSize = 5, #morphological disk
@@ -27,18 +48,13 @@ def deriveTexVals(texDf,
     texDf = texDf.copy()
     texDf['stimAngle'] = (-texDf['azimuth'].values*conventionSwitch)%360-180 #convert to -180 to 180 left handed convention
 
-    def deriveStimVel(angle, dt):
-        vel = angle.diff()
-        vel[np.abs(vel)>(np.nanmean(vel)+std_filter*np.nanstd(vel))] = 0
-        vel = np.round(ski.morphology.closing(ski.morphology.opening(vel,np.ones(diskSize)),
-                                              np.ones(diskSize))/dt,round)
-        return vel
-
     if 'texName' in texDf.columns:
+        groups = pd.factorize(texDf['texName'])[0]
         dt = np.nanmedian(texDf.groupby('texName')['time'].diff())
-        texDf['stimVel'] = texDf.groupby('texName')['stimAngle'].transform(deriveStimVel, dt)
     else:
-        texDf['stimVel'] = deriveStimVel(texDf['stimAngle'])
+        groups = np.zeros(len(texDf), dtype=int)
+        dt = np.nanmedian(texDf['time'].diff())
+    texDf['stimVel'] = groupedStimVel(texDf['stimAngle'].values, groups, dt, std_filter, diskSize, round)
     
     #apply morphological operation to remove unity noise and round off to the nearest 10th
     A = 1/(np.tan(screenAboveFly*np.pi/180)-np.tan(-screenBelowFly*np.pi/180))
@@ -67,23 +83,181 @@ def convertTextureVals(texDf, RF=True, divideBy = 'first'):
     texDf['sweepdir'] = np.sign(texDf.xtex) #right handed convention
     return texDf
 
-def deriveVidVals(uvrDat, movieFolderPath, imageFile = 'stimGenDf.csv', sceneFile='scene1DArray.npy', shift = -90):
+# movie assets (stimGenDf tables and scene arrays) shared by trials using the same movie folder,
+# keyed by file path and modification time so that regenerated files are reloaded
+_movieAssetCache = {}
+
+def _assetKey(filePath, kind):
+    return (kind, abspath(filePath), stat(filePath).st_mtime_ns)
+
+def loadStimGenDf(filePath):
+    # stimGenDf table, parsed once and shared between trials; each caller gets its own copy
+    key = _assetKey(filePath, 'stimGenDf')
+    if key not in _movieAssetCache:
+        _movieAssetCache[key] = pd.read_csv(filePath,index_col=0)
+    return _movieAssetCache[key].copy()
+
+def loadSceneArray(filePath):
+    # cached, read-only memory-mapped scene array; forked worker processes share the mapped pages
+    key = _assetKey(filePath, 'scene')
+    if key not in _movieAssetCache:
+        _movieAssetCache[key] = np.load(filePath, mmap_mode='r')
+    return _movieAssetCache[key]
+
+def clearMovieAssetCache():
+    _movieAssetCache.clear()
+
+class shiftedScene:
+    """ Scene array (images x azimuth pixels) shifted in azimuth without copying it
+    Indexing returns the same values as np.roll(base, shift, axis=-1)[key] but only reads the selected rows.
+    Note that each row is rolled separately, unlike the flattened np.roll of deriveVidVals' sceneArray.
+    """
+    def __init__(self, base, shift):
+        self.base = base
+        self.shift = int(shift) % base.shape[-1] if base.shape[-1] else 0
+
+    @property
+    def shape(self): return self.base.shape
+
+    @property
+    def dtype(self): return self.base.dtype
+
+    @property
+    def ndim(self): return self.base.ndim
+
+    def __len__(self): return len(self.base)
+
+    def columnIndex(self, cols=slice(None)):
+        # azimuth pixel indices into base for (shifted) columns cols
+        return (np.arange(self.base.shape[-1])[cols] - self.shift) % self.base.shape[-1]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple): key = (key,)
+        if self.base.ndim == 1 or len(key) == self.base.ndim:
+            rows, cols = key[:-1], key[-1]
+        else:
+            rows, cols = key, slice(None)
+        return np.asarray(self.base[rows])[..., self.columnIndex(cols)]
+
+    def __array__(self, dtype=None):
+        arr = self[...]
+        return arr if dtype is None else arr.astype(dtype)
+
+def deriveVidVals(uvrDat, movieFolderPath, imageFile = 'stimGenDf.csv', sceneFile='scene1DArray.npy', shift = -90,
+                  lazyScene = False):
+    # sceneArray: shifted scene array (ndarray, flattened np.roll by shift)
+    # sceneView: shiftedScene on the shared memory-mapped scene, each image row rolled by shift on access
+    # lazyScene=True only attaches sceneView and does not load the scene into memory
     movieFolder = uvrDat.vidDf['img'].str.split(r'\\').str.get(-2).unique()[-1]
     moviePath = movieFolderPath + movieFolder
     uvrDat.vidDf['filename'] = uvrDat.vidDf['img'].str.split(r'\\').str.get(-1)
     if imageFile is not None:
-        stimGenDf = pd.read_csv(sep.join([moviePath,imageFile]),index_col=0)
+        stimGenDf = loadStimGenDf(sep.join([moviePath,imageFile]))
         uvrDat.vidDf = pd.merge(uvrDat.vidDf, stimGenDf, on=['filename'])
     columnsToKeepVid = list(uvrDat.vidDf.columns)
     uvrDat.vidDf = pd.merge(uvrDat.posDf,uvrDat.vidDf,on = ['frame'],how='left').drop(columns='time_y').rename(columns={'time_x':'time'}).ffill()[columnsToKeepVid]
     if sceneFile is not None:
-        uvrDat.sceneArray = np.load(sep.join([moviePath,sceneFile]))
-        uvrDat.sceneArray = np.roll(uvrDat.sceneArray[:,:], shift=int(np.round(uvrDat.sceneArray.shape[-1]/360*shift)))
+        sceneArray = loadSceneArray(sep.join([moviePath,sceneFile]))
+        nshift = int(np.round(sceneArray.shape[-1]/360*shift))
+        uvrDat.sceneView = shiftedScene(sceneArray, nshift)
+        if not lazyScene: uvrDat.sceneArray = np.roll(np.asarray(sceneArray)[:,:], shift=nshift)
     return uvrDat
 
+class egocentricView:
+    """ Panorama seen by the fly on each frame: the displayed scene row rotated by the heading
+    view[t, j] = scene[image t, (j + angle t/360*W) mod W], optionally averaged over blocks of downsample azimuth pixels.
+    Frames are computed on access (view[100:200]) from per-frame row and shift indices with one gather,
+    so the whole movie is never materialised; use toFile to write it to a chunked memory-mapped .npy file.
+    """
+    def __init__(self, scene, rows, angle, downsample=1, conventionSwitch=1, dtype='float32'):
+        if isinstance(scene, shiftedScene): self.base, sceneShift = scene.base, scene.shift
+        else: self.base, sceneShift = scene, 0
+        W = self.base.shape[-1]
+        if W % downsample: raise ValueError(f'downsample must divide the scene width ({W})')
+
+        self.downsample = downsample
+        self.dtype = np.dtype(dtype)
+        rows = np.asarray(rows, dtype=float)
+        angle = np.asarray(angle, dtype=float)*conventionSwitch
+        self.valid = np.isfinite(rows) & np.isfinite(angle) & (rows >= 0) & (rows < len(self.base))
+        self.rows = np.where(self.valid, rows, 0).astype(int)
+        self.shifts = (np.round(np.where(self.valid, angle, 0)/360*W).astype(int) - sceneShift) % W
+        self.shape = (len(self.rows), W//downsample)
+
+    def __len__(self): return self.shape[0]
+
+    def _frames(self, ind):
+        W = self.base.shape[-1]
+        #read each displayed image once, then gather the rotated columns
+        urows, inv = np.unique(self.rows[ind], return_inverse=True)
+        images = np.asarray(self.base[urows], dtype=self.dtype)
+        view = images[inv[:,None], (np.arange(W)[None,:] + self.shifts[ind][:,None]) % W]
+        if self.downsample > 1:
+            view = view.reshape(len(ind), -1, self.downsample).mean(axis=-1)
+        view[~self.valid[ind]] = np.nan
+        return view
+
+    def __getitem__(self, frames):
+        ind = np.arange(len(self))[frames]
+        if np.ndim(ind) == 0: return self._frames(np.atleast_1d(ind))[0]
+        return self._frames(ind)
+
+    def __array__(self, dtype=None):
+        arr = self[:]
+        return arr if dtype is None else arr.astype(dtype)
+
+    def toFile(self, filePath, chunksize=4096):
+        # write all frames to a memory-mapped .npy file in chunks of frames and return it (read-only)
+        out = np.lib.format.open_memmap(filePath, mode='w+', dtype=self.dtype, shape=self.shape)
+        for start in range(0, len(self), chunksize):
+            out[start:start+chunksize] = self[start:start+chunksize]
+        out.flush()
+        del out
+        return np.load(filePath, mmap_mode='r')
+
+def getEgocentricView(uvrDat, imageIndex=None, downsample=1, outFile=None, chunksize=4096, conventionSwitch=1,
+                      dtype='float32'):
+    # egocentric view for every posDf frame from the output of deriveVidVals (rows of sceneView)
+    # imageIndex: vidDf column holding the scene row of each image; by default the integer filename stem (12.png -> 12)
+    # returns an egocentricView for on-demand access, or the memory-mapped array if outFile is given
+    if imageIndex is None:
+        rows = pd.to_numeric(uvrDat.vidDf['filename'].str.rsplit('.', n=1).str[0], errors='coerce').values
+    else:
+        rows = uvrDat.vidDf[imageIndex].values
+    view = egocentricView(uvrDat.sceneView, rows, uvrDat.posDf['angle'].values, downsample, conventionSwitch, dtype)
+    if outFile is not None: return view.toFile(outFile, chunksize)
+    return view
+
 def mergeSplitTexDfs(df, category_col='texName', ignore_cols=['time', 'frame', 'dt'], splitStrIndex = 0):
-    if splitStrIndex is not None: df[category_col] = df[category_col].str.replace('-','_').str.split('_').str[splitStrIndex]
+    if splitStrIndex is not None:
+        # split the unique names only and map back
+        names = pd.Series(df[category_col].unique())
+        df[category_col] = df[category_col].map(dict(zip(names, names.str.replace('-','_').str.split('_').str[splitStrIndex])))
     unique_categories = df[category_col].unique()
+    keys = list(ignore_cols)
+
+    # pivot all categories in one reshape if every (keys, category) row is unique
+    if (len(unique_categories) < 2 or pd.isna(unique_categories).any() or df[keys].isna().any(axis=None)
+        or df.duplicated(subset=keys+[category_col]).any()):
+        return mergeSplitTexDfsByMerge(df, category_col, ignore_cols, unique_categories)
+
+    value_cols = [col for col in df.columns if col not in keys and col != category_col]
+    wide = df.set_index(keys+[category_col])[value_cols].unstack(category_col)
+    wide.columns = [f"{col}_{category}" for col, category in wide.columns]
+
+    # cast columns back if unstacking introduced no missing rows
+    for col, category in [(col, category) for category in unique_categories for col in value_cols]:
+        name = f"{col}_{category}"
+        if wide[name].dtype != df[col].dtype and wide[name].notna().all():
+            wide[name] = wide[name].astype(df[col].dtype)
+
+    # column order as when merging category by category
+    columns = ([col if col in keys else f"{col}_{unique_categories[0]}" for col in df.columns if col != category_col]
+               + [f"{col}_{category}" for category in unique_categories[1:] for col in value_cols])
+    return wide.reset_index()[columns]
+
+def mergeSplitTexDfsByMerge(df, category_col='texName', ignore_cols=['time', 'frame', 'dt'], unique_categories=None):
+    if unique_categories is None: unique_categories = df[category_col].unique()
     dfs = []
 
     for category in unique_categories:
@@ -105,3 +279,158 @@ def mergeSplitTexDfs(df, category_col='texName', ignore_cols=['time', 'frame', '
 
     return merged_df
 
+
+
+# Image statistics for image (movie/luminance) protocols .......................
+imageStatCols = ['lumMean', 'lumStd', 'lumMin', 'lumMax', 'lumContrast']
+
+def imageName(img):
+    # file name of an image path logged with / or \\ separators
+    return pd.Series(img).str.split(r'[\\/]').str.get(-1).values
+
+def readImageProtocol(jsonPath):
+    # image sequence of a protocol json (one texture per display frame)
+    with open(jsonPath) as f: protocol = json.load(f)
+    return pd.DataFrame({'displayFrame': np.arange(len(protocol['textures'])),
+                         'img': protocol['textures'],
+                         'duration': protocol.get('durationSecs', np.nan)})
+
+def computeImageStats(image, nAzimuthBins=36):
+    # luminance (0-1) summary of one image: mean, std (RMS contrast), min, max, Michelson contrast
+    # and the mean luminance profile over nAzimuthBins bins along the image width
+    image = ski.util.img_as_float(image)
+    if image.ndim == 3:
+        image = ski.color.rgb2gray(image[...,:3]) if image.shape[-1] >= 3 else image[...,0]
+    lumMin, lumMax = image.min(), image.max()
+    contrast = (lumMax-lumMin)/(lumMax+lumMin) if lumMax+lumMin > 0 else 0
+    columns = image.mean(axis=0)
+    profile = np.array([b.mean() for b in np.array_split(columns, nAzimuthBins)])
+    return np.array([image.mean(), image.std(), lumMin, lumMax, contrast]), profile
+
+def fileHash(filePath):
+    import hashlib
+    with open(filePath, 'rb') as f: return hashlib.sha1(f.read()).hexdigest()
+
+def getImageStats(imageFolder, names, cacheDir=None, nAzimuthBins=36):
+    # decode each unique image once and return a DataFrame of imageStatCols indexed by image name
+    # and an array of azimuthal luminance profiles (names x nAzimuthBins) in the same order
+    # with cacheDir, statistics are stored per image content hash and reused across sessions
+    names = pd.unique(pd.Series(names).dropna())
+    stats = np.nan*np.ones((len(names), len(imageStatCols)))
+    profiles = np.nan*np.ones((len(names), nAzimuthBins))
+    if cacheDir is not None and not exists(cacheDir): makedirs(cacheDir)
+
+    for i, name in enumerate(names):
+        filePath = sep.join([imageFolder, name])
+        if not exists(filePath): continue
+        cacheFile = None
+        if cacheDir is not None:
+            cacheFile = sep.join([cacheDir, f'{fileHash(filePath)}_{nAzimuthBins}.npz'])
+            if exists(cacheFile):
+                with np.load(cacheFile) as cached:
+                    stats[i], profiles[i] = cached['stats'], cached['profile']
+                continue
+        stats[i], profiles[i] = computeImageStats(ski.io.imread(filePath), nAzimuthBins)
+        if cacheFile is not None: np.savez(cacheFile, stats=stats[i], profile=profiles[i])
+
+    return pd.DataFrame(stats, index=pd.Index(names, name='img'), columns=imageStatCols), profiles
+
+def addImageStats(vidDf, imageFolder, imgStr='img', cacheDir=None, nAzimuthBins=36):
+    # join image statistics onto vidDf (or readImageProtocol output) by image name
+    # returns vidDf with imageStatCols and the per-row azimuthal luminance profiles (rows x nAzimuthBins, NaN if no image)
+    vidDf = vidDf.copy()
+    names = imageName(vidDf[imgStr])
+    statsDf, profiles = getImageStats(imageFolder, names, cacheDir, nAzimuthBins)
+
+    ind = statsDf.index.get_indexer(names)
+    found = ind >= 0
+    rowStats = np.nan*np.ones((len(vidDf), len(imageStatCols)))
+    rowProfiles = np.nan*np.ones((len(vidDf), nAzimuthBins))
+    rowStats[found] = statsDf.values[ind[found]]
+    rowProfiles[found] = profiles[ind[found]]
+    vidDf[imageStatCols] = rowStats
+    return vidDf, rowProfiles
+
+
+# Stimulus epochs ...............................................................
+class stimEpochIndex:
+    """ Interval index of stimulus epochs, i.e. runs of constant stimulus values (e.g. img in vidDf or
+    stimSpeed and stimDir from deriveTexVals) in a frame-ordered stimulus table.
+    epochDf holds per epoch the key values, start/end frame and time and the row offsets into the stimulus table.
+    Ends are exclusive: the start of the next epoch, or just after the last row of the group for the last epoch.
+    Lookups use binary search on the epoch starts and slices of other frame- or time-sorted tables
+    (posDf, nidDf, expDf) are positional row ranges.
+    """
+    def __init__(self, stimDf, keys=['img'], groupStr=None, frameStr='frame', timeStr='time'):
+        self.keys, self.groupStr, self.frameStr, self.timeStr = list(keys), groupStr, frameStr, timeStr
+
+        sortcols = ([groupStr] if groupStr is not None else []) + [frameStr]
+        order = np.lexsort([stimDf[c].values for c in sortcols[::-1]])
+        codes = np.column_stack([pd.factorize(stimDf[c].values[order])[0] for c in self.keys + sortcols[:-1]])
+        change = np.r_[True, np.any(codes[1:] != codes[:-1], axis=1)]
+        if groupStr is not None: groupEnd = np.r_[codes[1:,-1] != codes[:-1,-1], True]
+        else: groupEnd = np.zeros(len(codes), dtype=bool); groupEnd[-1:] = True
+
+        startRows = np.flatnonzero(change)
+        endRows = np.r_[startRows[1:], len(order)]
+        frames = stimDf[frameStr].values[order]
+        times = stimDf[timeStr].values[order]
+        # epochs end where the next one starts, or with the last frame of their group
+        lastRow = endRows - 1
+        closesGroup = groupEnd[lastRow]
+        nextRow = np.minimum(endRows, len(order)-1)
+
+        epochDf = stimDf.iloc[order[startRows]][sortcols[:-1] + self.keys].reset_index(drop=True)
+        epochDf['startFrame'] = frames[startRows]
+        epochDf['endFrame'] = np.where(closesGroup, frames[lastRow] + 1, frames[nextRow])
+        epochDf['startTime'] = times[startRows]
+        epochDf['endTime'] = np.where(closesGroup, np.nextafter(times[lastRow], np.inf), times[nextRow])
+        epochDf['startRow'] = order[startRows]
+        epochDf['nRows'] = endRows - startRows
+        self.epochDf = epochDf.sort_values(['startTime', 'startFrame'], kind='stable').reset_index(drop=True)
+        self.epochDf.index.name = 'epoch'
+
+    def __len__(self): return len(self.epochDf)
+
+    def _groupMask(self, group):
+        if group is None or self.groupStr is None: return np.ones(len(self), dtype=bool)
+        return (self.epochDf[self.groupStr] == group).values
+
+    def epochAt(self, times=None, frames=None, group=None):
+        # epoch ids (-1 outside of any epoch) for times or frames, by binary search on the epoch starts
+        # pass group if epochs of different groups overlap
+        sel = np.flatnonzero(self._groupMask(group))
+        if frames is not None:
+            query, starts, ends = np.asarray(frames), self.epochDf['startFrame'].values[sel], self.epochDf['endFrame'].values[sel]
+        else:
+            query, starts, ends = np.asarray(times), self.epochDf['startTime'].values[sel], self.epochDf['endTime'].values[sel]
+        ind = np.searchsorted(starts, query, side='right') - 1
+        inEpoch = (ind >= 0) & (query < ends[np.maximum(ind, 0)])
+        return np.where(inEpoch, sel[np.maximum(ind, 0)], -1)
+
+    def rowRanges(self, df, by=None, pre=0, post=0):
+        # start and stop row offsets of every epoch (extended by pre/post in units of by) in a table sorted by column by
+        # by: frameStr (default) or timeStr of the index
+        if by is None: by = self.frameStr
+        if by == self.frameStr: start, end = self.epochDf['startFrame'].values, self.epochDf['endFrame'].values
+        else: start, end = self.epochDf['startTime'].values, self.epochDf['endTime'].values
+        values = df[by].values
+        return (np.searchsorted(values, start - pre, side='left'),
+                np.searchsorted(values, end + post, side='left'))
+
+    def slice(self, df, epoch, by=None, pre=0, post=0):
+        # rows of df (sorted by column by) during one epoch, as a positional slice without copying
+        lo, hi = self.rowRanges(df, by, pre, post)
+        return df.iloc[lo[epoch]:hi[epoch]]
+
+    def iterSlices(self, df, by=None, pre=0, post=0):
+        lo, hi = self.rowRanges(df, by, pre, post)
+        for epoch in range(len(self)):
+            yield epoch, df.iloc[lo[epoch]:hi[epoch]]
+
+def getStimEpochs(stimDf, keys=None, groupStr=None, frameStr='frame', timeStr='time'):
+    # epoch index for vidDf (by img) or texDf after deriveTexVals (by stimSpeed and stimDir, per texName)
+    if keys is None:
+        keys = ['img'] if 'img' in stimDf else [k for k in ['stimSpeed', 'stimDir'] if k in stimDf]
+    if groupStr is None and 'texName' in stimDf and 'img' not in keys: groupStr = 'texName'
+    return stimEpochIndex(stimDf, keys, groupStr, frameStr, timeStr)
@@ -35,3 +35,33 @@ def getClutterDf(objectDf, searchstr = 'default', renameClutterObjects = True):
         clutterDf = clutterDf.drop_duplicates()
     return clutterDf
 
+
+# circular statistics utils
+def rollingCircStats(angles, window, center=True, min_periods=None, deg=True):
+    #rolling circular mean and mean resultant length of angles from cumulative sums of cos and sin
+    #nan values are ignored, windows with fewer than min_periods (default: window) valid samples return nan
+    #returns the mean angle in radians (-pi,pi] and the resultant length [0,1]
+    angles = np.asarray(angles, dtype='float')
+    if deg: angles = np.deg2rad(angles)
+    if min_periods is None: min_periods = window
+
+    n = len(angles)
+    valid = np.isfinite(angles)
+    C = np.concatenate([[0], np.cumsum(np.where(valid, np.cos(angles), 0))])
+    S = np.concatenate([[0], np.cumsum(np.where(valid, np.sin(angles), 0))])
+    N = np.concatenate([[0], np.cumsum(valid)])
+
+    #window for sample i spans [start, end), centered windows follow the pandas convention
+    start = np.arange(n) - (window//2 if center else window-1)
+    end = np.clip(start + window, 0, n)
+    start = np.clip(start, 0, n)
+
+    count = N[end]-N[start]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        c = (C[end]-C[start])/count
+        s = (S[end]-S[start])/count
+    enough = count >= max(min_periods, 1)
+
+    pvaAngle = np.where(enough, np.arctan2(s, c), np.nan)
+    pvaMag = np.where(enough, np.hypot(c, s), np.nan)
+    return pvaAngle, pvaMag
@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# Replay a preprocessed imaging + VR recording volume by volume through the online bump tracker and
+# compare it with the offline (batch) bump PVA and offsets
+from os.path import sep
+import json
+import sys
+import numpy as np
+import pandas as pd
+from scipy.stats import circmean
+
+from unityvr.preproc import logproc
+from unityvr.analysis import align2img
+from unityvr.analysis import headDirection as hd
+
+
+def replayRecording(preprocDir, rate=None, img='img', vr='uvr', headingStr='angle', alpha=0.02):
+    imgDat = pd.read_csv(sep.join([preprocDir, img,'roiDFF.csv'])).drop(columns=['Unnamed: 0'], errors='ignore')
+    with open(sep.join([preprocDir, img,'imgMetadata.json'])) as json_file:
+        imgMetadat = json.load(json_file)
+    uvrDat = logproc.loadUVRData(sep.join([preprocDir, vr]))
+
+    imgInd, volFramePos = align2img.findImgFrameTimes(uvrDat,imgMetadat)
+    expDf = align2img.combineImagingAndPosDf(imgDat, uvrDat.posDf, volFramePos)
+
+    # online: one volume at a time (at the acquisition rate if given)
+    trackDf = hd.replayBumpTracker(expDf, headingStr=headingStr, rate=rate, alpha=alpha)
+
+    # offline: all volumes at once
+    pvaRad, pvaLen, _ = hd.getEBBumpPVA(expDf)
+    offset = np.mod(pvaRad - expDf[headingStr].values*np.pi/180, 2*np.pi)
+    offset[offset>np.pi] = offset[offset>np.pi] - 2*np.pi
+
+    return expDf, trackDf, pvaRad, pvaLen, offset
+
+def compareWithBatch(trackDf, pvaRad, pvaLen, offset, alpha=0.02):
+    # maximal deviation of the online phase, amplitude and per-volume offset from the batch values and
+    # the final online offset estimate next to the circular mean of the batch offsets of the last 1/alpha volumes
+    valid = np.isfinite(pvaRad)
+    last = offset[valid][-int(np.ceil(1/alpha)):]
+    return pd.Series({
+        'nvolumes': len(trackDf),
+        'pvaRad': np.nanmax(hd.circDistAbs(trackDf['pvaRad'].values[valid] % (2*np.pi), pvaRad[valid] % (2*np.pi))),
+        'pvaLen': np.nanmax(np.abs(trackDf['pvaLen'].values[valid] - pvaLen[valid])),
+        'offset': np.nanmax(hd.circDistAbs(trackDf['offset'].values[valid], offset[valid])),
+        'offsetEst': trackDf['offsetEst'].values[-1],
+        'batchOffset': circmean(last, high=np.pi, low=-np.pi),
+        'latency_median [ms]': np.median(trackDf['latency'].values)*1e3,
+        'latency_max [ms]': np.max(trackDf['latency'].values)*1e3,
+    })
+
+
+if __name__ == "__main__":
+    # get command line argument
+    if len(sys.argv) < 2:
+        print('Please specify a preprocessed trial directory containing the imaging ("img", with roiDFF.csv and imgMetadata.json)\
+        and VR ("uvr") data. Optionally, provide the acquisition rate in volumes/s as second argument to replay in real time.')
+    else:
+        rate = float(sys.argv[2]) if len(sys.argv) > 2 else None
+        expDf, trackDf, pvaRad, pvaLen, offset = replayRecording(sys.argv[1], rate)
+        print(compareWithBatch(trackDf, pvaRad, pvaLen, offset).to_string())
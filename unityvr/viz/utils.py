@@ -1,4 +1,5 @@
 import matplotlib.pyplot as plt
+import numpy as np
 from os.path import sep, exists
 from os import makedirs
 
@@ -43,3 +44,38 @@ def pathPlotAxisTheme(myax, units):
     myax.set_aspect('equal')
     myax.set_xlabel('x [{}]'.format(units))
     myax.set_ylabel('y [{}]'.format(units))
+
+
+## Decimated plotting of long traces
+def minMaxEnvelope(y, nbins, x=None):
+    # min and max of each of nbins consecutive sample blocks, in sample order
+    # (2*nbins points that draw the same envelope as the full trace at nbins pixels width)
+    y = np.asarray(y, dtype=float)
+    x = np.arange(len(y)) if x is None else np.asarray(x)
+    k = int(np.ceil(len(y)/max(nbins,1)))
+    if k <= 2: return x, y
+    yb = np.r_[y, np.full((-len(y)) % k, np.nan)].reshape(-1, k)
+    imin = np.argmin(np.where(np.isnan(yb), np.inf, yb), axis=1)
+    imax = np.argmax(np.where(np.isnan(yb), -np.inf, yb), axis=1)
+    idx = np.sort(np.column_stack([imin, imax]), axis=1) + k*np.arange(len(yb))[:,None]
+    idx = np.minimum(idx.ravel(), len(y)-1)
+    return x[idx], y[idx]
+
+def windowSlice(n, xlim, x=None):
+    # sample range [lo, hi) covering xlim plus one sample on either side, x (default: sample index) must be increasing
+    if xlim is None: return 0, n
+    if x is None: lo, hi = int(np.floor(xlim[0])), int(np.ceil(xlim[1]))+1
+    else: lo, hi = np.searchsorted(x, xlim[0], 'left'), np.searchsorted(x, xlim[1], 'right')
+    return max(lo-1, 0), min(hi+1, n)
+
+def plotEnvelope(ax, y, x=None, xlim=None, fmt='-', nPixels=None, **kwargs):
+    # plot a long trace drawing only the samples in xlim: at full resolution if the window has
+    # at most two samples per pixel, otherwise as per-pixel min/max envelope
+    lo, hi = windowSlice(len(y), xlim, x)
+    yw = np.asarray(y)[lo:hi]
+    xw = np.arange(lo, hi) if x is None else np.asarray(x)[lo:hi]
+    if nPixels is None: nPixels = int(ax.get_window_extent().width)
+    if len(yw) > 2*nPixels: xw, yw = minMaxEnvelope(yw, nPixels, xw)
+    lines = ax.plot(xw, yw, fmt, **kwargs)
+    if xlim is not None: ax.set_xlim(xlim[0], xlim[1])
+    return lines
@@ -99,11 +99,62 @@ def summaryOffsetDetection(axs, offsetreg,rawoffset,kdevals,samplpts, kdepeaks,
     return axs
 
 
+## Level-of-detail rendering of long trajectories
+def dataPerPixel(ax, x, y):
+    # data units per display pixel when the path fills the axes with equal aspect
+    bbox = ax.get_window_extent()
+    xrange, yrange = np.nanmax(x)-np.nanmin(x), np.nanmax(y)-np.nanmin(y)
+    return max(xrange/max(bbox.width,1), yrange/max(bbox.height,1))
+
+def decimatePath(x, y, pixelSize, maxPoints=None, maxIter=30, keep=None):
+    # indices of path samples that enter a new pixel cell, consecutive samples within one cell are dropped
+    # first and last samples, NaN breaks and samples marked in keep (boolean) are kept;
+    # cells are coarsened until at most maxPoints samples remain
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    n = len(x)
+    if n < 3 or not np.isfinite(pixelSize) or pixelSize <= 0: return np.arange(n)
+    x0, y0 = np.nanmin(x), np.nanmin(y)
+    forced = np.zeros(n, dtype='bool') if keep is None else np.asarray(keep, dtype='bool')
+
+    for i in range(maxIter):
+        ix, iy = np.floor((x-x0)/pixelSize), np.floor((y-y0)/pixelSize)
+        kept = np.r_[True, (ix[1:] != ix[:-1]) | (iy[1:] != iy[:-1])] | forced
+        kept[-1] = True
+        nkeep = np.sum(kept)
+        if maxPoints is None or nkeep <= maxPoints: return np.flatnonzero(kept)
+        pixelSize *= max(1.2, np.sqrt(nkeep/maxPoints))
+
+    # budget not reachable by coarsening (e.g. many NaN breaks): evenly subsample the kept samples
+    idx = np.flatnonzero(kept)
+    return idx[np.unique(np.linspace(0, len(idx)-1, maxPoints).astype(int))]
+
+def lodIndices(ax, x, y, maxPoints=None, pixelSize=None, keep=None):
+    # samples to draw for a path on ax; maxPoints=None draws all samples
+    if maxPoints is None: return np.arange(len(x))
+    if pixelSize is None: pixelSize = dataPerPixel(ax, x, y)
+    return decimatePath(x, y, pixelSize, maxPoints, keep=keep)
+
+def colorLine(ax, x, y, c, cmap, norm, linewidth=1, rasterized=False, connected=None):
+    # colour-mapped line (one segment per sample pair, coloured by the value at its start)
+    # connected: boolean per sample pair, pairs marked False are not drawn (gaps in the path)
+    from matplotlib.collections import LineCollection
+    points = np.column_stack([x, y])
+    segments, c = np.stack([points[:-1], points[1:]], axis=1), np.asarray(c, dtype=float)[:-1]
+    if connected is not None: segments, c = segments[connected], c[connected]
+    lc = LineCollection(segments, cmap=cmap, norm=norm, linewidth=linewidth, rasterized=rasterized)
+    lc.set_array(c)
+    ax.add_collection(lc)
+    ax.autoscale_view()
+    return lc
+
+
 ## Fly paths
-def plotFlyPath(uvrTest, convfac, figsize):
+def plotFlyPath(uvrTest, convfac, figsize, maxPoints=None, rasterized=False):
     fig, axs = plt.subplots(1,2,figsize=figsize, gridspec_kw={'width_ratios':[20,1]})
-    axs[0].plot(uvrTest.posDf.x*convfac,uvrTest.posDf.y*convfac,color='grey', linewidth=0.5)
-    cb = axs[0].scatter(uvrTest.posDf.x*convfac,uvrTest.posDf.y*convfac,s=5,c=uvrTest.posDf.angle, cmap='hsv')
+    x, y = uvrTest.posDf.x.values*convfac, uvrTest.posDf.y.values*convfac
+    idx = lodIndices(axs[0], x, y, maxPoints)
+    axs[0].plot(x[idx],y[idx],color='grey', linewidth=0.5, rasterized=rasterized)
+    cb = axs[0].scatter(x[idx],y[idx],s=5,c=uvrTest.posDf.angle.values[idx], cmap='hsv', rasterized=rasterized)
     axs[0].plot(uvrTest.posDf.x[0]*convfac,uvrTest.posDf.y[0]*convfac,'ok')
     axs[0].text(uvrTest.posDf.x[0]*convfac+0.2,uvrTest.posDf.y[0]*convfac+0.2,'start')
     axs[0].plot(uvrTest.posDf.x.values[-1]*convfac,uvrTest.posDf.y.values[-2]*convfac,'sk')
@@ -111,14 +162,18 @@ def plotFlyPath(uvrTest, convfac, figsize):
 
     return fig, axs
 
-def plotVRpathWithObjects(uvrExperiment,limx,limy, myfigsize):
+def plotVRpathWithObjects(uvrExperiment,limx,limy, myfigsize, maxPoints=None, rasterized=False):
 
     fig, ax = plt.subplots(1,1, figsize=myfigsize)
 
     ax = plotAllObjects(uvrExperiment, ax)
 
-    ax.plot(uvrExperiment.posDf['x'], uvrExperiment.posDf['y'],color='grey',alpha=0.5)
-    ax.scatter(uvrExperiment.posDf['x'], uvrExperiment.posDf['y'],s=7,c=uvrExperiment.posDf['time'],cmap='viridis')
+    x, y = uvrExperiment.posDf['x'].values, uvrExperiment.posDf['y'].values
+    # decimate at the resolution of the plotted window
+    pixelSize = dataPerPixel(ax, limx, limy) if np.isfinite(limx[0]) else None
+    idx = lodIndices(ax, x, y, maxPoints, pixelSize)
+    ax.plot(x[idx], y[idx],color='grey',alpha=0.5, rasterized=rasterized)
+    ax.scatter(x[idx], y[idx],s=7,c=uvrExperiment.posDf['time'].values[idx],cmap='viridis', rasterized=rasterized)
 
     if np.isfinite(limx[0]):
         ax.set_xlim(limx[0], limx[1])
@@ -153,9 +208,15 @@ def plotObjectEllipse(ax, rad, pos):
     return ax
 
 
-def plotTraj(ax,xpos,ypos,param,size=5,unit="cm", cmap='twilight_shifted', limvals=(0,360), discrete=False):
+def plotTraj(ax,xpos,ypos,param,size=5,unit="cm", cmap='twilight_shifted', limvals=(0,360), discrete=False,
+             maxPoints=None, style='scatter', linewidth=1, rasterized=False, sampleIndex=None):
+    # maxPoints: draw at most maxPoints samples, consecutive samples within one display pixel are merged
+    # style: 'scatter' (markers) or 'line' (colour-mapped LineCollection)
+    # sampleIndex: original sample numbers of a subset of the path (e.g. selected by a condition),
+    # the line is not drawn across samples left out of the subset
     
     color_map = plt.get_cmap(cmap)
+    param = np.asarray(param)
     
     #discrete colormap
     if discrete:
@@ -164,12 +225,22 @@ def plotTraj(ax,xpos,ypos,param,size=5,unit="cm", cmap='twilight_shifted', limva
         
         if pd.Series(np.diff(np.unique(param))).dropna().min()>0:
             norm = colors.BoundaryNorm(np.arange(m, M, pd.Series(np.diff(np.unique(param))).dropna().min()), color_map.N)
-            cb = ax.scatter(xpos,ypos,s=size,c=param,cmap=color_map, norm=norm)
         else:
-            cb = ax.scatter(xpos,ypos,s=size,c=param,cmap=color_map, vmin=m, vmax=M)
+            norm = colors.Normalize(vmin=m, vmax=M)
     else:
         #continuous colormap
-        cb = ax.scatter(xpos,ypos,s=size,c=param,cmap=color_map, vmin=limvals[0], vmax=limvals[1])
+        norm = colors.Normalize(vmin=limvals[0], vmax=limvals[1])
+
+    sampleIndex = np.arange(len(xpos)) if sampleIndex is None else np.asarray(sampleIndex)
+    gap = np.diff(sampleIndex) > 1
+    idx = lodIndices(ax, xpos, ypos, maxPoints, keep=np.r_[gap, False] | np.r_[False, gap])
+    xpos, ypos, param = np.asarray(xpos)[idx], np.asarray(ypos)[idx], param[idx]
+
+    if style == 'line':
+        connected = np.diff(sampleIndex[idx]) == np.diff(idx)
+        cb = colorLine(ax, xpos, ypos, param, color_map, norm, linewidth, rasterized, connected)
+    else:
+        cb = ax.scatter(xpos,ypos,s=size,c=param,cmap=color_map, norm=norm, rasterized=rasterized)
         
     ax.plot(xpos[0],ypos[0],'ok')
     ax.text(xpos[0]+0.2,ypos[0]+0.2,'start')
@@ -192,8 +263,12 @@ def plotTrajwithParameterandCondition(df, figsize, parameter='angle',
                                       stitch = False,
                                       mylimvals = (0,360),
                                       discrete = False,
-                                      dc2cm = 10
+                                      dc2cm = 10,
+                                      maxPoints = None,
+                                      style = 'scatter',
+                                      rasterized = False
                                      ):
+    # maxPoints, style and rasterized control the level of detail of long trajectories (see plotTraj)
 
     #if conversion is not specified, use default conversion
     if not hasattr(df,'dc2cm'):
@@ -212,13 +287,17 @@ def plotTrajwithParameterandCondition(df, figsize, parameter='angle',
         y_label='y'
 
     if plotOriginal:
-        axs[0].plot(df[x_label]*df.dc2cm,df[y_label]*df.dc2cm,color=color, linewidth=0.5)
+        x, y = df[x_label].values*df.dc2cm, df[y_label].values*df.dc2cm
+        idx = lodIndices(axs[0], x, y, maxPoints)
+        axs[0].plot(x[idx],y[idx],color=color, linewidth=0.5, rasterized=rasterized)
 
     if len(df.loc[condition])>0:
         axs[0],cb = plotTraj(axs[0],df.loc[condition,x_label].values*df.dc2cm,
                              df.loc[condition,y_label].values*df.dc2cm,
                              df[parameter].loc[condition].transform(transform),
-                             5,"cm", mycmap, mylimvals, discrete=discrete)
+                             5,"cm", mycmap, mylimvals, discrete=discrete,
+                             maxPoints=maxPoints, style=style, rasterized=rasterized,
+                             sampleIndex=np.flatnonzero(np.asarray(condition)))
         plt.colorbar(cb,cax=axs[1],label=parameter)
 
     return fig, axs